@@ -3,7 +3,8 @@
 from procreate_repair import recover_embedded
 
 from . import (chkdir, deflate, detect_zip, partial_layer_writer,
-               procreate_drawing, recover_embedded)
+               procreate_drawing, rebuild_zip, recover_embedded, verify_zip)
+from .metrics import METRICS
 
 CHK_DIR_NAME = '../chunks'
 
@@ -13,6 +14,9 @@ def main(step: int, preview: bool = True):
     if step == 0:
         # detect zips
         detect_zip.detect_zip(CHK_DIR_NAME)
+        # flag zip fragments whose data fails its crc32 as [verified: false]
+        verify_zip.verify_zips(detect_zip.ZIPS_FILENAME, CHK_DIR_NAME,
+            catalog_filename=detect_zip.CATALOG_FILENAME)
         # move zip json to -> ./resources/recovered/partials.fragments.json
         # move unknown json to ->  ./resources/unknown/partials.unknown.json
     elif step == 1:
@@ -21,19 +25,22 @@ def main(step: int, preview: bool = True):
         recover_embedded.recover_range_file('./resources/recovered/partials.fragments.json',
             CHK_DIR_NAME, './resources/embedded/' + sub_dir, preview)
 
-    # see ./scripts/complete.js for more information on developing the intermediate files
+    # see ./scripts/complete.js for more information on developing the intermediate files, or
+    # develop them in-process with complete.complete(detect_zip.ZIPS_FILENAME, CHK_DIR_NAME,
+    # './resources/recovered'), passing its implied blocks to deflate.deflate_range_list and its
+    # layer_ranges() to partial_layer_writer.recover_layers
     elif step == 2:
         # extract procreate configuration files for further analysis
         deflate.deflate_ranges('./resources/recovered/archives/ranges.json', CHK_DIR_NAME,
             './resources/archives')
     elif step == 3:
-        # extract partial procreate files as full directories
-        # then compress them as .zip
+        # rebuild partial procreate files as .zip, copying the compressed entries as they are
+        # (or deflate.deflate_ranges(json_file, CHK_DIR_NAME, out_dir) to extract directories)
         for index in [1, 2, 3]: # block numbers
             print("rebuilding " + str(index))
             json_file = './resources/recovered/implied' + '/block.' + str(index) + '.json'
             out_dir = './resources/recovered/implied' + '/' + str(index) + '/'
-            deflate.deflate_ranges(json_file, CHK_DIR_NAME, out_dir)
+            rebuild_zip.rebuild_ranges(json_file, CHK_DIR_NAME, out_dir + 'Archive.zip')
     elif step == 3:
         # extract preview image
         for index in [1, 2, 3]: # block numbers
@@ -45,7 +52,10 @@ def main(step: int, preview: bool = True):
                 drawing.write_layer(drawing.composite_uuid, out_file)
     elif step == 4:
         # recover layers as png
-        reader = chkdir.ChkDirReader(CHK_DIR_NAME)
+        reader = chkdir.ChkDirReader(CHK_DIR_NAME, manifest=True)
         partial_layer_writer.recover_manifest('./resources/recovered/layers/manifest.json', reader)
 
+    # bytes read, seeks, inflate/lzo/png timings, tiles per second, etc. of this step
+    METRICS.write_report('./metrics.' + str(step) + '.json')
+
 # main(0)
@@ -0,0 +1,179 @@
+"""Indexed catalog (SQLite) of fragments detected in a chkdir"""
+import re
+import sqlite3
+from typing import Iterable, Union
+
+UUID = re.compile('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', re.IGNORECASE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY, start INTEGER, end INTEGER, valid INTEGER,
+    zip_start INTEGER, dir_start INTEGER, dir_count INTEGER, verified INTEGER
+);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY, archive_id INTEGER, start INTEGER, end INTEGER, name TEXT, fid TEXT,
+    layer_uuid TEXT, layer TEXT, corrupt INTEGER, verified INTEGER
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    id INTEGER PRIMARY KEY, archive_id INTEGER, name TEXT, ref TEXT,
+    file_start INTEGER, file_end INTEGER, corrupt INTEGER
+);
+CREATE TABLE IF NOT EXISTS unknowns (
+    id INTEGER PRIMARY KEY, start INTEGER, end INTEGER, magic TEXT
+);
+CREATE INDEX IF NOT EXISTS archives_start ON archives (start);
+CREATE INDEX IF NOT EXISTS entries_archive ON entries (archive_id);
+CREATE INDEX IF NOT EXISTS entries_start ON entries (start);
+CREATE INDEX IF NOT EXISTS entries_name ON entries (name);
+CREATE INDEX IF NOT EXISTS entries_fid ON entries (fid);
+CREATE INDEX IF NOT EXISTS entries_layer_uuid ON entries (layer_uuid);
+CREATE INDEX IF NOT EXISTS entries_layer ON entries (layer);
+CREATE INDEX IF NOT EXISTS dirs_archive ON dirs (archive_id);
+CREATE INDEX IF NOT EXISTS dirs_name ON dirs (name);
+CREATE INDEX IF NOT EXISTS dirs_ref ON dirs (ref);
+CREATE INDEX IF NOT EXISTS unknowns_start ON unknowns (start);
+"""
+
+def entry_layer(fid: str) -> tuple[Union[str, None], Union[str, None]]:
+    """
+    Layer uuid and layer id (uuid/[date, time], as all chunks of a layer are written together)
+    of a chunk entry fid, or None for entries that are not chunks
+    """
+    if UUID.search(fid) is None:
+        return (None, None)
+    parts = fid.split('/')
+    return (parts[0], parts[0] + '/' + parts[-1])
+
+class Catalog:
+    """
+    Fragments detected in a chkdir, as archives (zip fragments), entries (their local file
+    headers), dirs (their central directory records) and unknowns (unknown data ranges).
+    Archives are numbered in detection order from 1, matching the zips json file.
+    """
+    def __init__(self, filename: str) -> None:
+        self.__connection = sqlite3.connect(filename)
+        self.__connection.row_factory = sqlite3.Row
+        self.__connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        """Commit and close the catalog"""
+        self.__connection.commit()
+        self.__connection.close()
+
+    def clear(self) -> None:
+        """Remove all fragments"""
+        for table in ['archives', 'entries', 'dirs', 'unknowns']:
+            self.__connection.execute('DELETE FROM ' + table)
+
+    def add_zip(self, fragment: dict) -> int:
+        """Add a json encoded zip fragment, returning its archive id"""
+        cursor = self.__connection.execute(
+            'INSERT INTO archives (start, end, valid, zip_start, dir_start, dir_count, verified)'
+            + ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (fragment['start'], fragment['end'], fragment['valid'], fragment['zip_start'],
+                fragment['dir_start'], fragment['dir_count'], fragment.get('verified')))
+        archive_id = cursor.lastrowid
+        entries = []
+        for file in fragment.get('files', []):
+            [layer_uuid, layer] = entry_layer(file['fid'])
+            entries.append((archive_id, file['start'], file['end'], file['name'], file['fid'],
+                layer_uuid, layer, file['corrupt'], file.get('verified')))
+        self.__connection.executemany(
+            'INSERT INTO entries (archive_id, start, end, name, fid, layer_uuid, layer, corrupt,'
+            + ' verified) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', entries)
+        self.__connection.executemany(
+            'INSERT INTO dirs (archive_id, name, ref, file_start, file_end, corrupt)'
+            + ' VALUES (?, ?, ?, ?, ?, ?)',
+            [(archive_id, zip_dir['name'], zip_dir['ref'], zip_dir['offset'][0],
+                zip_dir['offset'][1], zip_dir['corrupt']) for zip_dir in fragment.get('dirs', [])])
+        return archive_id
+
+    def add_unknown(self, fragment: dict) -> None:
+        """Add a json encoded unknown fragment"""
+        self.__connection.execute('INSERT INTO unknowns (start, end, magic) VALUES (?, ?, ?)',
+            (fragment['start'], fragment['end'], fragment['magic']))
+
+    def add_fragments(self, zips: Iterable[dict], unknowns: Iterable[dict]) -> None:
+        """Replace the catalog contents with json encoded fragments"""
+        self.clear()
+        for fragment in zips:
+            self.add_zip(fragment)
+        for fragment in unknowns:
+            self.add_unknown(fragment)
+        self.__connection.commit()
+
+    def set_verified(self, archive_id: int, fragment: dict) -> None:
+        """Record the verify_zip flags of a json encoded zip fragment"""
+        self.__connection.execute('UPDATE archives SET verified = ? WHERE id = ?',
+            (fragment['verified'], archive_id))
+        self.__connection.executemany(
+            'UPDATE entries SET verified = ? WHERE archive_id = ? AND start = ?',
+            [(file['verified'], archive_id, file['start']) for file in fragment.get('files', [])])
+
+    def commit(self) -> None:
+        """Commit changes"""
+        self.__connection.commit()
+
+    def archives(self, valid: Union[bool, None] = None) -> list[sqlite3.Row]:
+        """Zip fragments, optionally only those (not) found valid, excluding any failing verify"""
+        query = 'SELECT * FROM archives WHERE verified IS NOT 0'
+        if valid is not None:
+            query += ' AND valid = ' + ('1' if valid else '0')
+        return self.__connection.execute(query + ' ORDER BY start').fetchall()
+
+    def archive_at(self, offset: int) -> Union[sqlite3.Row, None]:
+        """The zip fragment containing an offset"""
+        return self.__connection.execute(
+            'SELECT * FROM archives WHERE start <= ? AND end > ? ORDER BY start DESC LIMIT 1',
+            (offset, offset)).fetchone()
+
+    def entries(self, name: Union[str, None] = None, fid: Union[str, None] = None,
+        layer_uuid: Union[str, None] = None, layer: Union[str, None] = None,
+        intact: bool = False
+    ) -> list[sqlite3.Row]:
+        """
+        Entries (zipped files) by name, fid, layer uuid and/or layer id, in chkdir order.
+        If intact, entries marked corrupt by detect_zip or failed by verify_zip are excluded.
+        """
+        query = 'SELECT * FROM entries WHERE 1'
+        params: list = []
+        for [column, value] in [('name', name), ('fid', fid), ('layer_uuid', layer_uuid),
+            ('layer', layer)]:
+            if value is not None:
+                query += ' AND ' + column + ' = ?'
+                params.append(value)
+        if intact:
+            query += ' AND corrupt < 0 AND verified IS NOT 0'
+        return self.__connection.execute(query + ' ORDER BY start', params).fetchall()
+
+    def entry_at(self, offset: int) -> Union[sqlite3.Row, None]:
+        """The entry containing an offset"""
+        return self.__connection.execute(
+            'SELECT * FROM entries WHERE start <= ? AND end > ? ORDER BY start DESC LIMIT 1',
+            (offset, offset)).fetchone()
+
+    def layers(self) -> list[str]:
+        """Layer ids (uuid/[date, time]) of all chunk entries"""
+        return [row['layer'] for row in self.__connection.execute(
+            'SELECT DISTINCT layer FROM entries WHERE layer IS NOT NULL ORDER BY layer')]
+
+    def dirs(
+        self, ref: Union[str, None] = None, name: Union[str, None] = None
+    ) -> list[sqlite3.Row]:
+        """Central directory records by referenced fid and/or name"""
+        query = 'SELECT * FROM dirs WHERE 1'
+        params: list = []
+        for [column, value] in [('ref', ref), ('name', name)]:
+            if value is not None:
+                query += ' AND ' + column + ' = ?'
+                params.append(value)
+        return self.__connection.execute(query + ' ORDER BY id', params).fetchall()
+
+    def unknowns(self, start: int = 0, end: int = -1) -> list[sqlite3.Row]:
+        """Unknown data ranges overlapping [start, end)"""
+        query = 'SELECT * FROM unknowns WHERE end >= ?'
+        params = [start]
+        if end > -1:
+            query += ' AND start < ?'
+            params.append(end)
+        return self.__connection.execute(query + ' ORDER BY start', params).fetchall()
@@ -1,31 +1,133 @@
 """Work with a directory of .CHK files as a single readable stream"""
 
-from os import listdir
-from os.path import getsize, isfile, join
+import hashlib
+import io
+import json
+import mmap
+import os
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from os.path import join, normpath
 from typing import BinaryIO, Union
 
+from .metrics import METRICS
 from .utils import format_bytes
 
+MAX_OPEN = 32 # default number of chunk files kept open
+MANIFEST_SUFFIX = '.manifest.json'
+RANGE_BUFFER_SIZE = 2**16 # read-ahead of buffered ranges, batching zip header and plist reads
+
+def manifest_filename(dirname: str) -> str:
+    """Manifest cache file for a chkdir, kept beside (not in) the directory"""
+    return normpath(dirname) + MANIFEST_SUFFIX
+
+def list_chunks(dirname: str) -> list[tuple[str, int, int]]:
+    """List chunk files as [(name, size, mtime ns)], in alphabetical (chunk) order"""
+    chunks: list[tuple[str, int, int]] = []
+    with os.scandir(dirname) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                chunks.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    chunks.sort() # chunks are in alphabetical order
+    return chunks
+
+def fingerprint_chunks(chunks: list[tuple[str, int, int]]) -> str:
+    """Fingerprint of a chunk listing, changes if any file is added, removed or modified"""
+    digest = hashlib.sha1()
+    for [name, size, mtime] in chunks:
+        digest.update((name + ':' + str(size) + ':' + str(mtime) + '\n').encode('utf-8'))
+    return digest.hexdigest()
+
+def load_chunks(dirname: str, verify: bool = False) -> list[tuple[str, int, int]]:
+    """
+    List chunk files using the manifest cache when the directory is unchanged since it was written,
+    otherwise list the directory and (re)write the manifest.
+    Adding, removing or renaming files updates the directory mtime, which invalidates the cache,
+    but rewriting a chunk file in place does not. With verify every chunk file is also stat'ed,
+    and the manifest rewritten if any name, size or mtime has changed.
+    """
+    filename = manifest_filename(dirname)
+    dir_mtime = os.stat(dirname).st_mtime_ns
+    chunks: Union[list[tuple[str, int, int]], None] = None
+    try:
+        with open(filename, 'r') as file:
+            manifest = json.load(file)
+        if manifest['dir_mtime'] == dir_mtime:
+            cached = [tuple(chunk) for chunk in manifest['chunks']]
+            if not verify:
+                return cached
+            chunks = list_chunks(dirname)
+            if chunks == cached:
+                return chunks
+            print('[manifest] chunk files changed in place, rebuilding ' + filename)
+    except (OSError, ValueError, KeyError):
+        pass # missing or unreadable, rebuild
+
+    if chunks is None:
+        chunks = list_chunks(dirname)
+    manifest = {
+        'dir_mtime': dir_mtime,
+        'fingerprint': fingerprint_chunks(chunks),
+        'chunks': chunks
+    }
+    try:
+        temp_filename = filename + '.' + str(os.getpid()) + '.tmp' # readers may be in parallel
+        with open(temp_filename, 'w') as file:
+            json.dump(manifest, file)
+        os.replace(temp_filename, filename)
+    except OSError:
+        print('[manifest] could not write ' + filename)
+    return chunks
 
 class ChkDirReader:
-    """Exposes a directory of files as a continuos stream"""
-    def __init__(self, dirname: str) -> None:
-        filenames = [f for f in listdir(dirname) if isfile(join(dirname, f))]
-        filenames.sort() # chunks are in alphabetical order
+    """
+    Exposes a directory of files as a continuos stream.
+    With manifest the chunk listing is cached beside the directory (see load_chunks), with verify
+    the cached listing is checked against every chunk file.
+    """
+    def __init__(
+        self, dirname: str,
+        use_mmap: bool = False, max_open: int = MAX_OPEN, buffer_size: int = 0,
+        manifest: bool = False, verify: bool = False
+    ) -> None:
+        chunks = load_chunks(dirname, verify) if manifest else list_chunks(dirname)
+        self.__dirname = dirname
+        self.__chunks: list[tuple[str, int, int]] = chunks
+        self.__fingerprint: Union[str, None] = None
+        self.__fresh: bool = verify or not manifest # listing was stat'ed, not cached
         self.__filenames: list[str] = [] # filenames by index
         self.__ranges: list[tuple[int, int]] = [] # [inc. start, exc. end] offset ranages by index
         offset = 0
-        for filename in filenames:
+        for [filename, size, _] in chunks:
             start = offset
             fullpath = join(dirname, filename)
             self.__filenames.append(fullpath)
-            offset += getsize(fullpath)
+            offset += size
             self.__ranges.append([start, offset])
 
+        self.__starts: list[int] = [start for [start, _] in self.__ranges] # bisect index
+
         self.__size: int = offset # exclusive offset maximum
         self.__offset: int = 0 # next read pointer
         self.__index: int = -1 # open file index, -1 if none
         self.__file: Union[BinaryIO, None] = None
+        self.__use_mmap: bool = use_mmap # map chunk files rather than read them
+        self.__map: Union[mmap.mmap, None] = None # mapping of the open file, if mapped
+        # least recently used pool of open (file, mapping) handles by index
+        self.__max_open: int = max(1, max_open)
+        self.__handles: OrderedDict[int, tuple[BinaryIO, Union[mmap.mmap, None]]] = OrderedDict()
+        # read-ahead buffer of [buffer start, buffer start + buffer length), disabled if zero sized
+        self.__buffer_size: int = max(0, buffer_size)
+        self.__buffer: Union[bytes, memoryview] = b''
+        self.__buffer_start: int = 0
+        self.__stale: bool = False # true when offset has moved on from the chunk file position
+        self.__stats: dict[str, int] = { 'hits': 0, 'refills': 0, 'bypasses': 0 }
+        # least recently used pool of positional read descriptors by index, shared between threads
+        self.__fds: OrderedDict[int, int] = OrderedDict()
+        self.__fd_users: dict[int, int] = {} # in-flight reads by index, in use fds are not closed
+        self.__fd_lock = threading.Lock()
         self.__open(0) # open file
 
     @property
@@ -38,17 +140,63 @@ class ChkDirReader:
         """Next read position"""
         return self.__offset
 
+    @property
+    def chunks(self) -> list[tuple[str, int, int, int]]:
+        """Chunk files as [(name, start offset, end offset, mtime ns)]"""
+        return [(name, start, end, mtime)
+            for [[name, _, mtime], [start, end]] in zip(self.__chunks, self.__ranges)]
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Fingerprint of the chunk files (names, sizes and mtimes), to check cached results.
+        Always from a stat of every chunk file; if a cached listing turns out to be stale the
+        reader's offsets are wrong too, so this raises rather than fingerprint either.
+        """
+        if self.__fingerprint is None:
+            if not self.__fresh:
+                if list_chunks(self.__dirname) != self.__chunks:
+                    raise Exception("Chunk files changed since the manifest was written, "
+                        + "open the reader with verify=True")
+                self.__fresh = True
+            self.__fingerprint = fingerprint_chunks(self.__chunks)
+        return self.__fingerprint
+
+    @property
+    def buffer_stats(self) -> dict[str, int]:
+        """Read-ahead buffer counters: reads served from memory, refills and unbuffered reads"""
+        return dict(self.__stats)
+
     def close(self) -> None:
         """Closes any open handles"""
+        self.__buffer = b''
+        self.__release()
+        for [file, _] in self.__handles.values():
+            file.close()
+        self.__handles.clear()
+        with self.__fd_lock:
+            for fd in self.__fds.values():
+                os.close(fd)
+            self.__fds.clear()
+            self.__fd_users.clear()
+
+    def __release(self) -> None:
+        """Forget the current file, leaving it pooled"""
         self.__index = -1
-        if  self.__file:
-            self.__file.close()
-            self.__file = None
+        self.__file = None
+        self.__map = None
+
+    def __locate(self, offset: int) -> int:
+        """Index of the chunk file containing offset, -1 if out of range"""
+        if (offset < 0 or offset >= self.__size):
+            return -1
+        # empty files share their start with the next file, so take the right-most
+        return bisect_right(self.__starts, offset) - 1
 
     def __open(self, index: int) -> None:
         if (index < 0 or index >= len(self.__filenames)):
             # out of bounds, close file
-            self.close()
+            self.__release()
             return
         if index == self.__index:
             # re-requested open file
@@ -56,14 +204,30 @@ class ChkDirReader:
             return
 
         # else chunk file has changed:
-        self.close() # clear up
         self.__index = index
+        if index in self.__handles:
+            # pooled, so no need to reopen
+            self.__handles.move_to_end(index)
+            [self.__file, self.__map] = self.__handles[index]
+            self.__file.seek(0)
+            return
 
         filename = self.__filenames[self.__index]
         [start, end] = self.__ranges[self.__index]
         print('[chunk] ' + filename + " (" + format_bytes(end - start) + ")")
+        METRICS.count('reader.opens')
 
         self.__file = open(filename, 'rb')
+        self.__map = None
+        if self.__use_mmap and end > start:
+            # empty files cannot be mapped, but are never read from either
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__handles[index] = (self.__file, self.__map)
+
+        while len(self.__handles) > self.__max_open:
+            # mappings are not closed explicitly, they are released with their last exported view
+            [_, [file, _]] = self.__handles.popitem(last=False)
+            file.close()
 
     def seek(self, offset: int, mode: int = 0) -> int:
         """
@@ -75,20 +239,40 @@ class ChkDirReader:
             - 3: relative to start of current file
             - 4: relative to start of next file
         """
+        METRICS.count('reader.seeks')
+        if mode >= 3:
+            self.__sync() # current file must be known
         if mode == 1:
-            self.__offset += offset
+            target = self.__offset + offset
         elif mode == 2:
-            self.__offset = (self.__size - 1) - offset
+            target = (self.__size - 1) - offset
         elif mode == 3:
-            self.__offset = self.__ranges[self.__index][0] + offset
+            target = self.__ranges[self.__index][0] + offset
         elif mode == 4:
-            self.__offset = self.__ranges[self.__index][1] + offset
+            target = self.__ranges[self.__index][1] + offset
         else: # mode==0
-            self.__offset = offset
+            target = offset
+
+        if self.__buffer_size > 0:
+            # chunk file is positioned lazily, on the next read that misses the buffer
+            self.__offset = target
+            self.__stale = True
+            return self.__offset
+        return self.__seek(target)
+
+    def __sync(self) -> None:
+        """Position the chunk file after buffered reads and seeks"""
+        if self.__stale:
+            self.__stale = False
+            self.__seek(self.__offset)
+
+    def __seek(self, offset: int) -> int:
+        """Seek to an offset relative to the start of directory, repointing the chunk file"""
+        self.__offset = offset
 
         if (self.__offset < 0 or self.__offset >= self.__size):
             # out of range
-            self.close()
+            self.__release()
             return self.__offset
 
         if  self.__index > -1:
@@ -104,35 +288,51 @@ class ChkDirReader:
                 self.__file.seek(0)
                 return self.__offset
 
-        for i in range(len(self.__ranges)):
-            [start, end] = self.__ranges[i]
-            if (self.__offset >= start and self.__offset < end):
-                self.__open(i) # update index, and repoint chunk file
-                self.__file.seek(self.__offset - start)
-                return self.__offset
+        i = self.__locate(self.__offset)
+        [start, end] = self.__ranges[i]
+        if (self.__offset >= start and self.__offset < end):
+            self.__open(i) # update index, and repoint chunk file
+            self.__file.seek(self.__offset - start)
+            return self.__offset
 
         # indicates that offset cannot be found within the ranges, should be impossible:
         raise Exception("Seek failed because of inconsistent chunk internals")
 
-    def read(self, length: int) -> bytes:
-        """Read length number of bytes inclusive of the current offset"""
+    def __read_chunk(self, length: int) -> Union[bytes, memoryview]:
+        """Read up to length bytes from the open chunk file, without rolling to the next"""
+        if self.__map is None:
+            data = self.__file.read(length)
+            METRICS.count('reader.bytes_read', len(data))
+            return data
+        position = self.__file.tell()
+        data = memoryview(self.__map)[position:position + length]
+        self.__file.seek(position + len(data))
+        METRICS.count('reader.bytes_read', len(data))
+        return data
+
+    def __read_pieces(self, length: int) -> list[Union[bytes, memoryview]]:
+        """Read length bytes as a list of per chunk file pieces, advancing the offset"""
         remaining = length
 
+        self.__sync()
+
         if self.__offset >= self.__size:
             # out of range
-            self.seek(0, self.__offset + length)
-            return bytes()
+            self.__seek(self.__offset + length)
+            return []
 
         if self.__offset < 0:
             # exhaust to seek to zero
             remaining += self.__offset
-            if remaining >= 0:
-                self.seek(0, 0)
+            if remaining < 0:
+                self.__seek(self.__offset + length)
+                return []
+            self.__seek(0)
 
-        stack: bytearray = bytearray()
+        pieces: list[Union[bytes, memoryview]] = []
         while remaining > 0:
-            data = self.__file.read(remaining)
-            stack.extend(data)
+            data = self.__read_chunk(remaining)
+            pieces.append(data)
             data_len = len(data)
             remaining -= data_len
 
@@ -143,13 +343,198 @@ class ChkDirReader:
                 # roll to next file
                 if self.__index + 1 < len(self.__ranges):
                     # data remains to be read, seek to next chunk
-                    self.seek(0, 4)
+                    self.__seek(self.__ranges[self.__index][1])
                 else:
                     # out of range
-                    self.seek(remaining + data_len, 1)
+                    self.__seek(self.__offset + remaining + data_len)
                     remaining = 0
             else:
                 # negative remainder, should be impossible:
                 raise Exception("Read failed because of inconsistent chunk internals")
 
-        return bytes(stack)
+        return pieces
+
+    def __read_buffered(self, length: int) -> bytes:
+        """Read length bytes through the read-ahead buffer"""
+        start = self.__offset - self.__buffer_start
+        if (start < 0 or start + length > len(self.__buffer)):
+            # miss, refill from the current offset
+            self.__stats['refills'] += 1
+            offset = self.__offset
+            pieces = self.__read_pieces(max(length, self.__buffer_size))
+            self.__buffer = pieces[0] if len(pieces) == 1 else b''.join(pieces)
+            self.__buffer_start = offset
+            self.__offset = offset
+            start = 0
+        else:
+            self.__stats['hits'] += 1
+        self.__offset += length
+        self.__stale = True
+        return bytes(self.__buffer[start:start + length])
+
+    def read(self, length: int) -> bytes:
+        """Read length number of bytes inclusive of the current offset"""
+        if (0 < length <= self.__buffer_size and 0 <= self.__offset < self.__size):
+            return self.__read_buffered(length)
+        if self.__buffer_size > 0:
+            self.__stats['bypasses'] += 1
+        pieces = self.__read_pieces(length)
+        if len(pieces) == 1:
+            return bytes(pieces[0]) # no-op for file reads, single copy for mapped reads
+        return b''.join(pieces)
+
+    def read_view(self, length: int) -> memoryview:
+        """
+        Read length number of bytes inclusive of the current offset as a memoryview.
+        When mapped (use_mmap) a range within a single chunk file is returned without copying,
+        ranges spanning chunk files are stitched together with a single copy.
+        Views always bypass the read-ahead buffer.
+        """
+        pieces = self.__read_pieces(length)
+        if len(pieces) == 1:
+            return memoryview(pieces[0])
+        return memoryview(b''.join(pieces))
+
+    def __acquire_fd(self, index: int) -> int:
+        """Borrow a positional read descriptor for a chunk file"""
+        with self.__fd_lock:
+            if index in self.__fds:
+                self.__fds.move_to_end(index)
+                self.__fd_users[index] += 1
+                return self.__fds[index]
+            fd = os.open(self.__filenames[index], os.O_RDONLY)
+            METRICS.count('reader.opens')
+            self.__fds[index] = fd
+            self.__fd_users[index] = 1
+            idle = [i for i in self.__fds if self.__fd_users[i] == 0]
+            while (len(self.__fds) > self.__max_open and len(idle) > 0):
+                i = idle.pop(0) # oldest first
+                os.close(self.__fds.pop(i))
+                del self.__fd_users[i]
+            return fd
+
+    def __release_fd(self, index: int) -> None:
+        with self.__fd_lock:
+            if index in self.__fd_users:
+                self.__fd_users[index] -= 1
+
+    def __pieces_at(self, start: int, end: int) -> list[tuple[int, int, int]]:
+        """Split [start, end) into (chunk index, chunk position, length) pieces"""
+        start = max(start, 0)
+        end = min(end, self.__size)
+        pieces: list[tuple[int, int, int]] = []
+        index = self.__locate(start)
+        while (start < end and index > -1):
+            [chunk_start, chunk_end] = self.__ranges[index]
+            length = min(end, chunk_end) - start
+            if length > 0: # skip empty files
+                pieces.append((index, start - chunk_start, length))
+            start += length
+            index += 1
+        return pieces
+
+    def read_at(self, offset: int, length: int) -> bytes:
+        """
+        Read length number of bytes from offset without moving the read position.
+        Safe to call from multiple threads; the range is clipped to the directory.
+        """
+        stack: list[bytes] = []
+        for [index, position, size] in self.__pieces_at(offset, offset + length):
+            fd = self.__acquire_fd(index)
+            try:
+                while size > 0:
+                    data = os.pread(fd, size, position)
+                    if len(data) == 0:
+                        raise Exception("Read failed because of inconsistent chunk internals")
+                    stack.append(data)
+                    position += len(data)
+                    size -= len(data)
+                    METRICS.count('reader.bytes_read', len(data))
+            finally:
+                self.__release_fd(index)
+        if len(stack) == 1:
+            return stack[0]
+        return b''.join(stack)
+
+    def view(self, start: int, end: int) -> memoryview:
+        """
+        Read the range [start, end) into a single buffer without moving the read position.
+        Chunk files are read straight into the buffer, so spanning ranges are not stitched.
+        Safe to call from multiple threads; the range is clipped to the directory.
+        """
+        pieces = self.__pieces_at(start, end)
+        buffer = memoryview(bytearray(sum(size for [_, _, size] in pieces)))
+        filled = 0
+        for [index, position, size] in pieces:
+            fd = self.__acquire_fd(index)
+            try:
+                while size > 0:
+                    read = os.preadv(fd, [buffer[filled:filled + size]], position)
+                    if read == 0:
+                        raise Exception("Read failed because of inconsistent chunk internals")
+                    filled += read
+                    position += read
+                    size -= read
+                    METRICS.count('reader.bytes_read', read)
+            finally:
+                self.__release_fd(index)
+        return buffer
+
+class ChkDirRange(io.RawIOBase):
+    """
+    A read-only, seekable file over the range [start, end) of a chkdir, e.g. an embedded zip to
+    open with zipfile. Only the bytes actually read are loaded, using read_at, so the reader's own
+    position is unchanged and several ranges may share a reader.
+    Reads are unbuffered, each is a positional read, so open ranges with buffered_range.
+    """
+    def __init__(self, reader: ChkDirReader, start: int, end: int) -> None:
+        super().__init__()
+        self.__reader = reader
+        self.__start = start
+        self.__size = max(0, min(end, reader.size) - start)
+        self.__position = 0
+
+    @property
+    def size(self) -> int:
+        """Range size"""
+        return self.__size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.__position
+        elif whence == io.SEEK_END:
+            offset += self.__size
+        if offset < 0:
+            raise ValueError("Negative seek position " + str(offset))
+        self.__position = offset
+        return self.__position
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = max(0, self.__size - self.__position)
+        if (size is None or size < 0 or size > remaining):
+            size = remaining
+        if size == 0:
+            return b''
+        data = self.__reader.read_at(self.__start + self.__position, size)
+        self.__position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+def buffered_range(
+    reader: ChkDirReader, start: int, end: int, buffer_size: int = RANGE_BUFFER_SIZE
+) -> io.BufferedReader:
+    """A ChkDirRange behind a read-ahead buffer, so small reads do not each read the chkdir"""
+    return io.BufferedReader(ChkDirRange(reader, start, end), buffer_size)
@@ -0,0 +1,262 @@
+"""
+Analyse detected zip fragments to resolve duplicate chunks, match central directory blocks,
+reassemble orphaned document archives and list every layer (see ./scripts/complete.js).
+Unlike complete.js, an intact chunk is never replaced by a later corrupt duplicate, each fid is
+listed once per layer, chunks failed by verify_zip count as corrupt and unreadable archives are
+skipped rather than fatal.
+"""
+import json
+import os
+import plistlib
+import re
+import zlib
+from typing import Callable, Union
+
+from .chkdir import ChkDirReader
+from .deflate import inflate_range
+
+UUID = re.compile(
+    r"\b[0-9a-f]{8}\b-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-\b[0-9a-f]{12}\b", re.IGNORECASE)
+DOCUMENT_ARCHIVE = 'Document.archive'
+
+def is_uuid(name: str) -> bool:
+    """Files including uuids are chunks (compressed bitmap tiles)"""
+    return UUID.search(name) is not None
+
+def is_corrupt(file: dict) -> bool:
+    """True if detect_zip marked a file corrupt, or verify_zip failed it"""
+    return file['corrupt'] > 0 or file.get('verified') is False
+
+def fid_layer(fid: str) -> tuple[str, str]:
+    """Layer uuid and timestamp of a chunk fid, all chunks in a layer are written at the same ts"""
+    parts = fid.split('/')
+    return (parts[0], parts[2])
+
+def timestamp(ts: str) -> int:
+    """Sortable time of a '[date, time]' timestamp"""
+    [lm_date, lm_time] = [int(part.strip(' []')) for part in ts.split(',')]
+    return lm_date * 24 * 60 * 60 + lm_time * 2
+
+def layer_filename(layer_id: str) -> str:
+    """File name for a layer id (uuid/[date, time])"""
+    return re.sub(r'(/\[|, |\])', '_', layer_id)
+
+def ranges_of(files: list[dict], key: str = 'file') -> list[dict]:
+    """[{ start, end, [key] }] ranges of files, key is the name field"""
+    return [{ 'start': file['start'], 'end': file['end'], key: file['name'] } for file in files]
+
+def archive_reader(reader: ChkDirReader) -> Callable[[dict], dict]:
+    """Load the plist of a Document.archive file from a chkdir, the caller closes the reader"""
+    def load(file: dict) -> dict:
+        return plistlib.loads(inflate_range(reader, file['start'], file['end']))
+    return load
+
+class Analysis:
+    """
+    Partial zip fragments indexed by fid (archives and chunks), by layer (uuid/ts) and by layer
+    uuid, with the blocks implied by central directories and orphaned archives.
+    """
+    def __init__(self, fragments: list[dict], load_archive: Callable[[dict], dict]) -> None:
+        self.archives: dict[str, dict] = {}
+        self.chunks: dict[str, dict] = {}
+        self.alternatives: dict[str, list[dict]] = {}
+        self.layers: dict[str, dict[str, None]] = {} # layer id -> ordered fids
+        self.layer_timestamps: dict[str, list[str]] = {} # layer uuid -> timestamps
+        self.blocks: list[dict] = []
+        self.implied: dict[int, list[dict]] = {} # block -> file ranges
+
+        # assume contiguous blocks should remain together; ignore embedded, but otherwise
+        # complete, zip fragments
+        partials: list[dict] = []
+        for [index, fragment] in enumerate(fragments):
+            if fragment['valid']:
+                continue
+            for file in fragment['files'] + fragment['dirs']:
+                file['block'] = index
+            partials.append(fragment)
+        print('found ' + str(len(partials)) + ' partials')
+
+        for partial in partials:
+            for file in partial['files']:
+                if file['name'] == DOCUMENT_ARCHIVE:
+                    self.__add_archive(file, load_archive)
+                elif is_uuid(file['name']):
+                    self.__add_chunk(file)
+        print('archives: ' + str(len(self.archives)) + ' (corrupt: '
+            + str(len([f for f in self.archives.values() if is_corrupt(f)])) + ')')
+        print('chunks: ' + str(len(self.chunks)) + ' (corrupt: '
+            + str(len([f for f in self.chunks.values() if is_corrupt(f)])) + ', alternatives: '
+            + str(len(self.alternatives)) + ')')
+        print('layers: ' + str(len(self.layers)))
+
+        for layer_id in self.layers:
+            [uuid, ts] = layer_id.split('/')
+            self.layer_timestamps.setdefault(uuid, []).append(ts)
+
+        for partial in partials:
+            if len(partial['dirs']) > 0:
+                self.__match_block(partial)
+        for archive in self.archives.values():
+            if not archive.get('used'):
+                self.__reassemble(archive)
+
+    def __add_archive(self, file: dict, load_archive: Callable[[dict], dict]) -> None:
+        """Each drawing includes a descriptive Document.archive"""
+        if file['fid'] in self.archives:
+            print(' > duplicate archive fid ' + file['fid'])
+        try:
+            objects = load_archive(file)['$objects']
+            composite = objects[objects[1]['composite'].data]
+            file['composite'] = objects[composite['UUID'].data]
+        except (plistlib.InvalidFileException, zlib.error, ValueError, KeyError, IndexError,
+            AttributeError, TypeError) as error:
+            print(' > skipping unreadable archive ' + file['fid'] + ' block ' + str(file['block'])
+                + ': ' + repr(error))
+            return
+        file['refs'] = [o for o in objects if isinstance(o, str) and is_uuid(o)]
+        self.archives[file['fid']] = file
+
+    def __add_chunk(self, file: dict) -> None:
+        """Index a chunk, preferring intact duplicates and noting alternatives"""
+        fid = file['fid']
+        existing = self.chunks.get(fid)
+        if existing is not None:
+            self.alternatives.setdefault(fid, [existing]).append(file)
+            if is_corrupt(file):
+                if is_corrupt(existing):
+                    print(' > could not replace corrupt duplicate ' + fid + ' block kept '
+                        + str(existing['block']) + '/' + str(file['block']))
+                else:
+                    return # do not replace existing whole file with corrupt version
+            elif not is_corrupt(existing):
+                this_size = file['end'] - file['start']
+                that_size = existing['end'] - existing['start']
+                if this_size != that_size:
+                    print(' > inconsistent duplicates discovered: ' + str(file['block']) + ' '
+                        + str(this_size) + '/' + str(existing['block']) + ' ' + str(that_size))
+        self.chunks[fid] = file
+        [uuid, ts] = fid_layer(fid)
+        self.layers.setdefault(uuid + '/' + ts, {})[fid] = None
+
+    def __match_block(self, partial: dict) -> None:
+        """Attempt to recover a block using its central zip directory"""
+        block = {
+            'bid': partial['dirs'][0]['block'],
+            # we can trust the cdr if the zip end block was found and it is prefixed by files
+            'trusted': len(partial['files']) > 0 and partial['end'] > 0,
+            'archive': None,
+            'found': [],
+            'missing': [],
+            'corrupt': [],
+            'layers': set(),
+        }
+        self.blocks.append(block)
+        print('considering block ' + str(block['bid']) + ', cdr trusted: '
+            + str(block['trusted']))
+        if block['trusted']:
+            return # skip for now
+
+        for zip_dir in partial['dirs']:
+            # only chunks and the archive are important
+            if zip_dir['name'] != DOCUMENT_ARCHIVE and not is_uuid(zip_dir['name']):
+                continue
+            if is_uuid(zip_dir['ref']):
+                [uuid, ts] = fid_layer(zip_dir['ref'])
+                block['layers'].add(uuid + '/' + ts)
+            file = self.chunks.get(zip_dir['ref']) or self.archives.get(zip_dir['ref'])
+            if file is None:
+                block['missing'].append(zip_dir['ref'])
+            elif file['name'] == DOCUMENT_ARCHIVE:
+                block['archive'] = file
+                file['used'] = True
+            elif is_corrupt(file):
+                block['corrupt'].append(file)
+            else:
+                block['found'].append(file)
+        print(' > archive: ' + str(block['archive'] is not None) + ', found: '
+            + str(len(block['found'])) + ', missing: ' + str(len(block['missing']))
+            + ', corrupt: ' + str(len(block['corrupt'])))
+
+    def later_whole(self, uuid: str) -> str:
+        """Layer id of the most recently written version of a layer"""
+        timestamps = self.layer_timestamps[uuid]
+        latest = timestamps[0]
+        for ts in timestamps:
+            if timestamp(ts) >= timestamp(latest):
+                latest = ts
+        return uuid + '/' + latest
+
+    def __reassemble(self, archive: dict) -> None:
+        """Reassemble the block of an orphaned archive from the layers it references"""
+        print('considering block ' + str(archive['block']))
+        ambiguous_count = 0
+        archive['layers'] = []
+        for ref in archive['refs']:
+            timestamps = self.layer_timestamps.get(ref)
+            if timestamps is None:
+                print(' > lost layer ' + ref)
+                continue
+            layer_id = ref + '/' + timestamps[0]
+            if len(timestamps) > 1:
+                layer_id = self.later_whole(ref)
+                print(' > ambiguous layer ref ' + ref + ' ' + str(len(timestamps)) + ' -> '
+                    + layer_id)
+                ambiguous_count += 1
+            archive['layers'].append(layer_id)
+
+        chunks: dict[str, dict] = {}
+        for layer_id in archive['layers']:
+            for fid in self.layers.get(layer_id, {}):
+                if not is_corrupt(self.chunks[fid]):
+                    chunks[fid] = self.chunks[fid]
+        self.implied[archive['block']] = ranges_of([archive] + list(chunks.values()))
+        print('recovery rate: ' + str(len(archive['refs']) - ambiguous_count) + '/'
+            + str(len(archive['refs'])))
+
+    def layer_ranges(self) -> dict[str, list[dict]]:
+        """Intact [{ start, end, name }] chunk ranges by layer id, empty layers are skipped"""
+        layer_ranges: dict[str, list[dict]] = {}
+        for [layer_id, fids] in self.layers.items():
+            files = [self.chunks[fid] for fid in fids if not is_corrupt(self.chunks[fid])]
+            if len(files) == 0:
+                print(' > empty layer ' + layer_id)
+                continue
+            layer_ranges[layer_id] = ranges_of(files, 'name')
+        return layer_ranges
+
+def complete(
+    zips_filename: str, dirname: str, out_dir: Union[str, None] = None,
+    load_archive: Union[Callable[[dict], dict], None] = None
+) -> Analysis:
+    """
+    Analyse the zip fragments of a detect_zip (or verify_zip) json file, loading archives from the
+    chkdir. With out_dir, write the files complete.js would (see above for differences):
+    implied/block.[n].json, layers/json/[layer].json and layers/manifest.json.
+    """
+    with open(zips_filename, 'r') as file:
+        fragments: list[dict] = json.load(file)
+    if load_archive is not None:
+        analysis = Analysis(fragments, load_archive)
+    else:
+        reader = ChkDirReader(dirname, manifest=True)
+        try:
+            analysis = Analysis(fragments, archive_reader(reader))
+        finally:
+            reader.close()
+    if out_dir is None:
+        return analysis
+
+    os.makedirs(os.path.join(out_dir, 'implied'), exist_ok=True)
+    for [block, ranges] in analysis.implied.items():
+        with open(os.path.join(out_dir, 'implied', 'block.' + str(block) + '.json'), 'w') as file:
+            json.dump(ranges, file, indent=2)
+    os.makedirs(os.path.join(out_dir, 'layers', 'json'), exist_ok=True)
+    manifest: list[str] = []
+    for [layer_id, ranges] in analysis.layer_ranges().items():
+        filename = os.path.join(out_dir, 'layers', 'json', layer_filename(layer_id) + '.json')
+        with open(filename, 'w') as file:
+            json.dump(ranges, file, indent=2)
+        manifest.append(filename)
+    with open(os.path.join(out_dir, 'layers', 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    return analysis
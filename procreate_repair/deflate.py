@@ -1,45 +1,186 @@
 """Utilities to extract embedded zip data from chkdirs"""
 import json
+import math
 import os
+import re
 import zlib
+from concurrent.futures import ProcessPoolExecutor
 
+from .catalog import Catalog
 from .chkdir import ChkDirReader
+from .metrics import METRICS, map_measured
 
 # from os import read
 
-def deflate_range(outfile: str, reader: ChkDirReader, start: int, end: int) -> None:
-    """Extract and decompress a range from a chkdir"""
-    reader.seek(start + 26)
-    name_len = int.from_bytes(reader.read(2), "little")
-    ext_len = int.from_bytes(reader.read(2), "little")
-    reader.seek(name_len + ext_len, 1)
+DEFLATE_READ_SIZE = 2**20 # compressed bytes read, and most bytes inflated, per step
+DEFLATE_BATCHES_PER_JOB = 4 # parallel ranges are split into more batches than jobs to balance load
 
-    size = end - reader.offset
-    data = reader.read(size)
+def entry_data_start(reader: ChkDirReader, start: int) -> int:
+    """
+    Offset of the data of the zip entry with a local header at start.
+    Raises zlib.error, as for any other undecodable range, if there is no local header at start.
+    """
+    header = reader.read_at(start, 30)
+    if len(header) < 30 or header[0:4] != b'PK\x03\x04':
+        raise zlib.error("No local file header at " + str(start))
+    lengths = header[26:30]
+    name_len = int.from_bytes(lengths[0:2], "little")
+    ext_len = int.from_bytes(lengths[2:4], "little")
+    return start + 30 + name_len + ext_len
 
-    decompress = zlib.decompressobj(-zlib.MAX_WBITS)
-    inflated = decompress.decompress(data)
-    inflated += decompress.flush()
+def inflate_range(reader: ChkDirReader, start: int, end: int) -> bytes:
+    """Decompress the zip entry in a chkdir range to memory"""
+    offset = entry_data_start(reader, start)
+    size = end - offset
+    data = reader.read_at(offset, size)
+
+    with METRICS.timer('deflate.inflate'):
+        decompress = zlib.decompressobj(-zlib.MAX_WBITS)
+        inflated = decompress.decompress(data)
+        inflated += decompress.flush()
+    METRICS.count('deflate.ranges')
+    METRICS.count('deflate.bytes_in', size)
+    METRICS.count('deflate.bytes_out', len(inflated))
+    METRICS.maybe_report()
+    return inflated
+
+def deflate_range(
+    outfile: str, reader: ChkDirReader, start: int, end: int
+) -> tuple[int, int, bool]:
+    """
+    Extract and decompress a range from a chkdir, streaming DEFLATE_READ_SIZE pieces to outfile.
+    Output inflated before a truncated or corrupt stream ends is kept, corrupt streams then raise.
+    Returns the number of compressed bytes read and decompressed bytes written, and whether the
+    stream was complete (false if the range, or the chkdir, ends before the stream does).
+    """
+    offset = entry_data_start(reader, start)
 
     dirname = os.path.dirname(outfile)
     os.makedirs(dirname, exist_ok=True)
 
+    [bytes_in, bytes_out] = [0, 0]
+    decompress = zlib.decompressobj(-zlib.MAX_WBITS)
     with open(outfile, 'xb') as file:
-        file.write(inflated)
+        try:
+            while offset < end and not decompress.eof:
+                data = reader.read_at(offset, min(DEFLATE_READ_SIZE, end - offset))
+                if len(data) == 0:
+                    break # range runs past the end of the chkdir
+                offset += len(data)
+                bytes_in += len(data)
+                while len(data) > 0 and not decompress.eof:
+                    with METRICS.timer('deflate.inflate'):
+                        inflated = decompress.decompress(data, DEFLATE_READ_SIZE)
+                    file.write(inflated)
+                    bytes_out += len(inflated)
+                    data = decompress.unconsumed_tail
+            inflated = decompress.flush()
+            file.write(inflated)
+            bytes_out += len(inflated)
+        finally:
+            METRICS.count('deflate.ranges')
+            METRICS.count('deflate.bytes_in', bytes_in)
+            METRICS.count('deflate.bytes_out', bytes_out)
+            METRICS.maybe_report()
+    if not decompress.eof:
+        print('truncated deflate stream ' + str(start) + '-' + str(end) + ', kept '
+            + str(bytes_out) + ' bytes')
     # plist_to_json(inflated, outfile)
+    return (bytes_in, bytes_out, decompress.eof)
 
-def deflate_ranges(filename: str, dirname: str, prefix: str) -> None:
+def deflate_range_status(out_file: str, reader: ChkDirReader, start: int, end: int) -> dict:
+    """
+    Deflate a range as deflate_range, but report rather than raise failures, as { file, start,
+    end, status: ok|exists|truncated|inflate_error|error, bytes_in, bytes_out[, error] }.
+    Partial output of truncated and corrupt (inflate_error) streams is kept.
+    """
+    status = { 'file': out_file, 'start': start, 'end': end, 'status': 'ok',
+        'bytes_in': 0, 'bytes_out': 0 }
+    try:
+        [status['bytes_in'], status['bytes_out'], complete] = deflate_range(
+            out_file, reader, start, end)
+        if not complete:
+            status['status'] = 'truncated'
+            status['error'] = 'stream ends after ' + str(status['bytes_in']) + ' compressed bytes'
+    except FileExistsError:
+        status['status'] = 'exists'
+    except zlib.error as error:
+        # corrupt, or no local header; partial output is kept
+        status['status'] = 'inflate_error'
+        status['error'] = str(error)
+        if os.path.exists(out_file):
+            status['bytes_out'] = os.path.getsize(out_file)
+    except Exception as error: # pylint: disable=broad-except
+        status['status'] = 'error'
+        status['error'] = str(error)
+    return status
+
+def deflate_batch(dirname: str, ranges: list[tuple[int, dict]], prefix: str) -> list[dict]:
+    """Deflate (index, range) pairs with a reader of its own, returning indexed statuses"""
+    reader = ChkDirReader(dirname, manifest=True)
+    statuses = []
+    for [index, fragment] in ranges:
+        status = deflate_range_status(
+            prefix + fragment['file'], reader, fragment['start'], fragment['end'])
+        status['index'] = index
+        statuses.append(status)
+    reader.close()
+    return statuses
+
+def deflate_ranges(filename: str, dirname: str, prefix: str, jobs: int = 1) -> list[dict]:
     """
     Given a json file of [{ file, start, end }] ranges, extract the range [start]-[end]
     from a chkdir, deflate and save the decompressed contents to [file]
+    Returns a status per range (see deflate_range_status), failed ranges do not stop the rest.
     """
-    reader = ChkDirReader(dirname)
-
     with open(filename, 'r') as file:
         ranges = json.load(file)
+    return deflate_range_list(ranges, dirname, prefix, jobs)
+
+def deflate_range_list(
+    ranges: list[dict], dirname: str, prefix: str, jobs: int = 1
+) -> list[dict]:
+    """
+    As deflate_ranges, for [{ file, start, end }] ranges already in memory.
+    With jobs > 1 ranges are split, in offset order, into contiguous batches deflated by a pool
+    of processes; statuses are returned in the order of ranges either way.
+    """
+    indexed = sorted(enumerate(ranges), key=lambda pair: pair[1]['start'])
+    if jobs > 1:
+        batch_size = max(1, math.ceil(len(indexed) / (jobs * DEFLATE_BATCHES_PER_JOB)))
+        batches = [indexed[index:index + batch_size]
+            for index in range(0, len(indexed), batch_size)]
+        with ProcessPoolExecutor(jobs) as executor:
+            results = list(map_measured(executor, deflate_batch,
+                [dirname] * len(batches), batches, [prefix] * len(batches)))
+        statuses = [status for batch in results for status in batch]
+    else:
+        statuses = deflate_batch(dirname, indexed, prefix)
+    statuses.sort(key=lambda status: status['index'])
+
+    failed = [status for status in statuses if status['status'] != 'ok']
+    for status in failed:
+        print('[deflate] ' + status['status'] + ' ' + str(status['start']) + '-'
+            + str(status['end']) + ' ' + status['file'] + ' ' + status.get('error', ''))
+    print('[deflate] ' + str(len(statuses) - len(failed)) + ' ok, ' + str(len(failed))
+        + ' failed')
+    return statuses
+
+def fid_filename(fid: str) -> str:
+    """File name for an entry fid, as used by ./scripts/complete.js"""
+    return re.sub(r'[\[\] ,/]', '_', fid)
+
+def deflate_entries(
+    catalog_filename: str, dirname: str, prefix: str, name: str, jobs: int = 1
+) -> list[dict]:
+    """
+    Deflate and save every intact entry called [name] (e.g. Document.archive) in a detect_zip
+    catalog to [prefix][fid], see fid_filename and deflate_range_list
+    """
+    catalog = Catalog(catalog_filename)
+    entries = catalog.entries(name=name, intact=True)
+    catalog.close()
 
-    for fragment in ranges:
-        start: int = fragment['start']
-        end: int = fragment['end']
-        out_file: str = prefix + fragment['file']
-        deflate_range(out_file, reader, start, end)
+    ranges = [{ 'file': fid_filename(entry['fid']), 'start': entry['start'], 'end': entry['end'] }
+        for entry in entries]
+    return deflate_range_list(ranges, dirname, prefix, jobs)
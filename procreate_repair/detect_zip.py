@@ -1,16 +1,41 @@
 """Detect zip files in chkdir streams"""
+import json
+import os
+import pickle
+import re
+import tempfile
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 from typing import Union
 
-from json_tricks import dump
-
+from .catalog import Catalog
 from .chkdir import ChkDirReader
+from .fragment_sink import (FragmentSink, JsonLinesSink, json_lines_to_json,
+                            read_json_lines)
+from .metrics import METRICS, map_measured
 from .utils import format_bytes
 
 PK_ZIP_FILE_HEADER = bytes([0x50, 0x4b, 0x3, 0x4])
 PK_ZIP_DIR_HEADER = bytes([0x50, 0x4b, 0x1, 0x2])
 PK_ZIP_EOF_HEADER = bytes([0x50, 0x4b, 0x5, 0x6])
+PK_ZIP_HEADERS = re.compile(b'|'.join(
+    map(re.escape, [PK_ZIP_FILE_HEADER, PK_ZIP_DIR_HEADER, PK_ZIP_EOF_HEADER])))
 EMPTY_BYTES = bytes([0])
+EMPTY_GAP = bytes(512) # UnknownFragments gap length
+NON_EMPTY_BYTES = re.compile(b'[^\\x00]')
+READ_AHEAD_SIZE = 16 * 2**20 # scan buffer, tune with ChkDirReader.buffer_stats
+SCAN_BLOCK_SIZE = 4 * 2**20 # unknown data searched for signatures per step
+SCAN_BLOCKS_CACHED = 2 # searched blocks kept, so rollbacks into the last block are not re-read
+SHARDS_PER_JOB = 4 # parallel scans are split into more shards than jobs to balance load
+ZIPS_FILENAME = './partials.zips.json'
+UNKNOWNS_FILENAME = './partials.unknown.json'
+CHECKPOINT_FILENAME = './partials.checkpoint'
+CATALOG_FILENAME = './partials.catalog.sqlite'
+CHECKPOINT_INTERVAL = 256 * 2**20 # bytes scanned between checkpoints
+INCREMENTAL_DIRNAME = './partials.incremental'
+INCREMENTAL_UNIT_SIZE = 64 * 2**20 # chunk files are cached in runs of at least this size
 
 class Block(Enum):
     """Chunk block types"""
@@ -221,17 +246,26 @@ class UnknownFragments:
 
     __GAP_LENGTH: int = 512
 
-    def __init__(self) -> None:
+    def __init__(self, sink: Union[FragmentSink, None] = None) -> None:
         self.__fragment_start: int = -1
         self.__fragment_end: int  = -1
         self.__empty_len: int = 0
-        self.__fragments: list[UnknownFragment] = []
+        self.__sink = sink if sink is not None else FragmentSink()
         self.__magic = bytearray()
         self.__rollback = False
 
     def __json_encode__(self):
-        fragments = map(lambda f: f.__json_encode__(), self.__fragments)
-        return list(fragments)
+        return list(self.__sink.unknowns)
+
+    @property
+    def count(self) -> int:
+        """Number of fragments collected"""
+        return self.__sink.unknown_count
+
+    @property
+    def idle(self) -> bool:
+        """True if no fragment is in progress"""
+        return self.__fragment_start < 0
 
     def process(self, data: bytes, offset: int) -> None:
         """Processes unknown bytes to fragments"""
@@ -257,6 +291,67 @@ class UnknownFragments:
 
         self.__fragment_end = offset
 
+    def process_block(self, data: bytes, offset: int) -> None:
+        """
+        Processes a run of unknown bytes, offset is as given to process for the first byte.
+        Equivalent to process for each byte, but empty runs are found with bytes searches.
+        """
+        gap_length = UnknownFragments.__GAP_LENGTH
+        position = 0
+        while position < len(data):
+            if self.__fragment_start < 0:
+                # empty bytes do not start a fragment
+                match = NON_EMPTY_BYTES.search(data, position)
+                if match is None:
+                    return
+                position = match.start()
+                self.__magic.clear()
+                self.__fragment_start = offset + position
+                self.__empty_len = 0
+
+            if len(self.__magic) < 4:
+                self.__magic.extend(data[position:position + 4 - len(self.__magic)])
+
+            if self.__empty_len > 0:
+                # continue an empty run from the previous block
+                match = NON_EMPTY_BYTES.search(data, position)
+                non_empty = match.start() if match is not None else len(data)
+                if self.__empty_len + non_empty - position >= gap_length:
+                    position += gap_length - self.__empty_len
+                    self.__fragment_end = offset + position - 2 # not updated by the flushing byte
+                    self.__empty_len = gap_length
+                    self.__flush()
+                    continue
+                if match is None:
+                    self.__empty_len += len(data) - position
+                    self.__fragment_end = offset + len(data) - 1
+                    return
+                position = non_empty
+                self.__empty_len = 0
+
+            gap = data.find(EMPTY_GAP, position)
+            if gap < 0:
+                # runs shorter than a gap only count at the end of the block
+                tail = data[max(position, len(data) - gap_length):]
+                self.__empty_len = len(tail) - len(tail.rstrip(EMPTY_BYTES))
+                self.__fragment_end = offset + len(data) - 1
+                return
+            position = gap + gap_length
+            self.__fragment_end = offset + position - 2
+            self.__empty_len = gap_length
+            self.__flush()
+
+    def checkpoint(self) -> tuple:
+        """State of the fragment in progress"""
+        return (self.__fragment_start, self.__fragment_end, self.__empty_len,
+            bytes(self.__magic), self.__rollback)
+
+    def restore(self, checkpoint: tuple) -> None:
+        """Restore the fragment in progress from a checkpoint"""
+        [self.__fragment_start, self.__fragment_end, self.__empty_len, magic,
+            self.__rollback] = checkpoint
+        self.__magic = bytearray(magic)
+
     def undo_header(self) -> None:
         """Undo last four bytes as known header"""
         if  self.__fragment_end > -1:
@@ -286,156 +381,562 @@ class UnknownFragments:
             self.__fragment_start, self.__fragment_end, self.__magic, self.__rollback)
         print(fragment)
         self.__rollback = False
-        self.__fragments.append(fragment)
+        self.__sink.add_unknown(fragment.__json_encode__())
         self.__fragment_start = -1
         self.__fragment_end = -1
 
-def detect_zip(dirname: str) -> None:
+class ZipScanner:
     """
-    Given a directory of .CHK files return:
-     - ./partials.zips.json : json encoded zip ranges (see ZipFragment)
-     - ./partials.unknown.json : json encoded unknown ranges (see UnknownFragments)
-    See ./scripts/complete.js for ways of working with this data.
+    Zip detection state machine over a chkdir stream.
+    Unknown data is searched a block at a time for zip signatures, so the state machine is only
+    stepped byte-by-byte at candidate headers and at the end of each header block.
     """
-    reader = ChkDirReader(dirname) # read/seek chunk
-    last_reported_progress = 0
-
-    state: Block = Block.UNKNOWN
-    header_buffer: bytearray = bytearray()
+    def __init__(
+        self, reader: ChkDirReader,
+        offset: int = 0, buffered: int = 4, sink: Union[FragmentSink, None] = None
+    ) -> None:
+        self.__reader = reader
+        self.__sink = sink if sink is not None else FragmentSink()
+        self.__state: Block = Block.UNKNOWN
+        # start as if the buffered bytes before offset had just been scanned
+        buffered = min(offset, buffered)
+        self.__header_buffer: bytearray = bytearray(reader.read_at(offset - buffered, buffered))
+        reader.seek(offset)
+        self.__zip_fragment: Union[ZipFragment, None] = None
+        self.__unknown_fragments = UnknownFragments(self.__sink)
+        self.__block_start = 0
+        self.__last_reported_progress = 0
+        # (offset, buffered, zip count, unknown count) at each quiet block boundary
+        self.__sync_points: list[tuple[int, int, int, int]] = []
+        self.__checkpoint_filename: Union[str, None] = None
+        self.__checkpoint_interval: int = CHECKPOINT_INTERVAL
+        self.__checkpoint_offset: int = offset
+        self.__furthest: int = offset
+        # searched blocks by index, as (data start offset, data, candidate signature offsets)
+        self.__blocks: OrderedDict[int, tuple[int, bytes, list[int]]] = OrderedDict()
 
-    zip_fragment = None
-    unknown_fragments = UnknownFragments()
+    @property
+    def sink(self) -> FragmentSink:
+        """Destination of closed fragments"""
+        return self.__sink
 
-    block_start = 0
+    @property
+    def sync_points(self) -> list[tuple[int, int, int, int]]:
+        """
+        Block boundaries passed while quiet, as (offset, buffered header bytes, zip count,
+        unknown count). Quiet means no zip or unknown fragment is open, so any scan that is quiet
+        at the same offset and buffer length detects exactly the same fragments from there on.
+        """
+        return self.__sync_points
+
+    def enable_checkpoints(self, filename: str, interval: int = CHECKPOINT_INTERVAL) -> None:
+        """Periodically save the scan state to filename, see restore_checkpoint"""
+        self.__checkpoint_filename = filename
+        self.__checkpoint_interval = interval
+
+    def save_checkpoint(self, filename: str) -> None:
+        """Save the scan state, and what has been added to the sink, to filename"""
+        checkpoint = {
+            'fingerprint': self.__reader.fingerprint,
+            'offset': self.__reader.offset,
+            'state': self.__state,
+            'header_buffer': bytes(self.__header_buffer),
+            'zip_fragment': self.__zip_fragment,
+            'unknown_fragments': self.__unknown_fragments.checkpoint(),
+            'block_start': self.__block_start,
+            'last_reported_progress': self.__last_reported_progress,
+            'sync_points': self.__sync_points,
+            'sink': self.__sink.checkpoint(),
+        }
+        with open(filename + '.tmp', 'wb') as file:
+            pickle.dump(checkpoint, file)
+        os.replace(filename + '.tmp', filename) # never leave a partial checkpoint
+        self.__checkpoint_offset = self.__reader.offset
+
+    def restore_checkpoint(self, filename: str) -> None:
+        """Continue from a saved scan state, discarding anything added to the sink since"""
+        with open(filename, 'rb') as file:
+            checkpoint = pickle.load(file)
+        if checkpoint['fingerprint'] != self.__reader.fingerprint:
+            raise Exception("Checkpoint was saved for different chunk files")
+        self.__reader.seek(checkpoint['offset'])
+        self.__state = checkpoint['state']
+        self.__header_buffer = bytearray(checkpoint['header_buffer'])
+        self.__zip_fragment = checkpoint['zip_fragment']
+        self.__unknown_fragments.restore(checkpoint['unknown_fragments'])
+        self.__block_start = checkpoint['block_start']
+        self.__last_reported_progress = checkpoint['last_reported_progress']
+        self.__sync_points = checkpoint['sync_points']
+        self.__sink.restore(checkpoint['sink'])
+        self.__checkpoint_offset = checkpoint['offset']
+        print('[checkpoint] resuming @' + str(checkpoint['offset']))
 
-    zip_fragments=[]
+    @property
+    def furthest(self) -> int:
+        """Furthest offset scanned up to, the fragments found depend on no data beyond it"""
+        return self.__furthest
+
+    def __quiet(self) -> bool:
+        return (self.__state == Block.UNKNOWN and self.__zip_fragment is None
+            and self.__unknown_fragments.idle)
+
+    def scan(self, end: int = -1) -> Union[tuple[int, int], None]:
+        """
+        Scan the reader from its current offset to the end of the stream, or, given an end, to
+        the first quiet block boundary at or after end.
+        Returns the (offset, buffered) sync point stopped at, or None at the end of the stream.
+        """
+        reader = self.__reader
+        while reader.offset < reader.size:
+            self.__furthest = max(self.__furthest, reader.offset)
+            progress =  (reader.offset * 100) // reader.size
+            if  progress != self.__last_reported_progress:
+                print('[progress]: ' + str(progress) + '%')
+                self.__last_reported_progress = progress
+
+            if self.__state == Block.UNKNOWN:
+                if (self.__checkpoint_filename is not None
+                    and reader.offset % SCAN_BLOCK_SIZE == 0
+                    and reader.offset - self.__checkpoint_offset >= self.__checkpoint_interval):
+                    self.save_checkpoint(self.__checkpoint_filename)
+                if (reader.offset % SCAN_BLOCK_SIZE == 0 and self.__quiet()):
+                    sync_point = (reader.offset, len(self.__header_buffer))
+                    self.__sync_points.append(sync_point
+                        + (self.__sink.zip_count, self.__sink.unknown_count))
+                    if (end > -1 and reader.offset >= end):
+                        return sync_point
+                self.__scan_block()
+            else:
+                self.__step()
+
+        self.__furthest = max(self.__furthest, reader.size)
+        self.__unknown_fragments.eof()
+        if self.__zip_fragment:
+            self.__zip_fragment.mark_corrupt(reader.size)
+            self.__sink.add_zip(self.__zip_fragment.__json_encode__())
+            self.__zip_fragment = None
+        return None
+
+    def __search_block(self, index: int) -> tuple[int, bytes, list[int]]:
+        """
+        Read and search a block for zip signatures once, returning its data (from just before
+        the block, for signatures split across blocks) and the offsets of every signature in it
+        """
+        if index in self.__blocks:
+            self.__blocks.move_to_end(index)
+            return self.__blocks[index]
+        reader = self.__reader
+        data_start = max(0, index * SCAN_BLOCK_SIZE - 4)
+        data = reader.read_at(data_start, (index + 1) * SCAN_BLOCK_SIZE - data_start)
+        # signatures cannot overlap, so every occurrence is found
+        candidates = [data_start + match.start() for match in PK_ZIP_HEADERS.finditer(data)]
+        self.__blocks[index] = (data_start, data, candidates)
+        while len(self.__blocks) > SCAN_BLOCKS_CACHED:
+            self.__blocks.popitem(last=False)
+        METRICS.count('detect_zip.blocks')
+        METRICS.count('detect_zip.bytes_searched', len(data))
+        return self.__blocks[index]
+
+    def __scan_block(self) -> None:
+        """
+        Pass unknown data up to the next zip signature, or block boundary, to the unknown fragments,
+        stepping into the signature if one is found. Blocks are read and searched once (see
+        __search_block), so rollbacks and zips closing mid-block do not search the block again.
+        """
+        reader = self.__reader
+        offset = reader.offset
+        block_end = min(reader.size, (offset // SCAN_BLOCK_SIZE + 1) * SCAN_BLOCK_SIZE)
+        [data_start, data, candidates] = self.__search_block(offset // SCAN_BLOCK_SIZE)
+        METRICS.maybe_report()
+        # the header buffer holds the bytes just before offset, so signatures may start in it
+        search_start = offset - len(self.__header_buffer)
+        candidate = bisect_left(candidates, search_start)
+
+        if candidate == len(candidates):
+            self.__unknown_fragments.process_block(
+                data[offset - data_start:block_end - data_start], offset + 1)
+            self.__header_buffer = bytearray(
+                data[max(search_start, block_end - 4) - data_start:block_end - data_start])
+            reader.seek(block_end)
+            return
 
-    while reader.offset < reader.size:
-        # build header
+        # last signature byte completes the header, so is scanned by the state machine
+        last = candidates[candidate] + 3
+        self.__unknown_fragments.process_block(
+            data[offset - data_start:last - data_start], offset + 1)
+        self.__header_buffer = bytearray(
+            data[max(search_start, last - 4) - data_start:last - data_start])
+        reader.seek(last)
+        self.__step()
+
+    def __step(self) -> None:
+        """Scan the next byte of the stream"""
+        reader = self.__reader
+        header_buffer = self.__header_buffer
         data = reader.read(1)
 
-        progress =  (reader.offset * 100) // reader.size
-        if  progress != last_reported_progress:
-            print('[progress]: ' + str(progress) + '%')
-            last_reported_progress = progress
-
         header_buffer.extend(data)
         if len(header_buffer) > 4:
             header_buffer.pop(0)
 
         if header_buffer == PK_ZIP_FILE_HEADER:
-            header_buffer.clear()
-            unknown_fragments.undo_header()
-            block_start = reader.offset - 4 # include header
-            if state != Block.FILE:
-                # start of zip file
-                if state != Block.UNKNOWN:
-                    print('unexpected FILE state from ' + str(state) + ' @' + str(reader.offset))
-                state = Block.FILE
-                if zip_fragment is not None:
-                    print('persisting partial zip fragment')
-                    zip_fragment.mark_corrupt(reader.offset)
-                    zip_fragments.append(zip_fragment)
-                    zip_fragment = ZipFragment()
-                zip_fragment = ZipFragment()
-            reader.seek(6, 1) # o+10
-            lm_time = int.from_bytes(reader.read(2), "little")
-            lm_date = int.from_bytes(reader.read(2), "little")
-            reader.seek(4, 1) # o+18
-            compressed_len = int.from_bytes(reader.read(4), "little")
-            reader.seek(4, 1) # o+26
-            name_len = int.from_bytes(reader.read(2), "little")
-            ext_len = int.from_bytes(reader.read(2), "little")
-            name = reader.read(name_len).decode("utf-8", "replace")
-            reader.seek(ext_len + compressed_len, 1) # to end of block
-            file = ZipFileFragment(block_start, reader.offset, name, [lm_date, lm_time])
-            zip_fragment.add_file(file)
-
+            self.__file_header()
         elif header_buffer == PK_ZIP_DIR_HEADER:
-            header_buffer.clear()
-            unknown_fragments.undo_header()
-            block_start = reader.offset - 4 # include header
-            if state != Block.DIR:
-                # start of central directory structure
-                if state != Block.FILE:
-                    print('unexpected DIR state from ' + str(state) + ' @' + str(reader.offset))
-                    if zip_fragment is not None:
-                        print('persisting partial zip fragment')
-                        zip_fragment.mark_corrupt(reader.offset)
-                        zip_fragments.append(zip_fragment)
-                    zip_fragment = ZipFragment()
-                state = Block.DIR
-            reader.seek(8, 1) # o+12
-            lm_time = int.from_bytes(reader.read(2), "little")
-            lm_date = int.from_bytes(reader.read(2), "little")
-            reader.seek(4, 1) # o+20
-            compressed_len = int.from_bytes(reader.read(4), "little")
-            reader.seek(4, 1) # o+28
-            name_len = int.from_bytes(reader.read(2), "little")
-            ext_len = int.from_bytes(reader.read(2), "little")
-            com_len = int.from_bytes(reader.read(2), "little")
-            reader.seek(8, 1) # o+42
-            relative_file_start = int.from_bytes(reader.read(4), "little")
-            relative_file_end = relative_file_start + compressed_len
-            name = reader.read(name_len).decode("utf-8", "replace")
-            reader.seek(ext_len + com_len, 1) # to end of block
-            zip_dir = ZipDirFragment(block_start, reader.offset, name,
-                [lm_date, lm_time], [relative_file_start, relative_file_end])
-            zip_fragment.add_dir(zip_dir)
-
+            self.__dir_header()
         elif header_buffer == PK_ZIP_EOF_HEADER:
-            header_buffer.clear()
-            unknown_fragments.undo_header()
-            block_start = reader.offset - 4 # include header
-            if state != Block.DIR:
-                # start of end of file header, there is only one
-                print('unexpected EOF state from ' + str(state) + ' @' + str(reader.offset))
-                if zip_fragment is not None:
-                    print('persisting partial zip fragment')
-                    zip_fragment.mark_corrupt(reader.offset)
-                    zip_fragments.append(zip_fragment)
-                    zip_fragment = ZipFragment()
-            state = Block.EOF
-            reader.seek(6, 1) # o+10
-            dir_count = int.from_bytes(reader.read(2), "little")
-            dir_size = int.from_bytes(reader.read(4), "little")
-            dir_offset = int.from_bytes(reader.read(4), "little")
-            dir_start = block_start - dir_size
-            zip_start = dir_start - dir_offset
-            com_len = int.from_bytes(reader.read(2), "little")
-            reader.seek(com_len, 1) # to end of block
-            zip_fragment.add_eof(block_start, reader.offset, dir_count, dir_start, zip_start)
-            print(zip_fragment)
-            zip_fragment.validate()
-            zip_fragments.append(zip_fragment)
-            zip_fragment = None
-
+            self.__eof_header()
         else:
-            unknown_fragments.process(data, reader.offset)
+            self.__unknown_fragments.process(data, reader.offset)
             if len(header_buffer) >= 4: # let buffer fill before calling empty/data
-                if state != Block.UNKNOWN:
-                    if state == Block.FILE:
-                        print('partial zip @' + str(reader.offset))
-                        zip_fragment.likely()
-                        zip_fragment.mark_corrupt(reader.offset)
-                        zip_fragments.append(zip_fragment)
-                        zip_fragment = None
-                        reader.seek(block_start + 1)
-                        print('rolling back @' + str(reader.offset))
-                        unknown_fragments.rollback()
-                    elif state != Block.EOF:
-                        print('unexpected UNKNOWN state from '
-                            + str(state) + ' @' + str(reader.offset))
-                        reader.seek(block_start + 1)
-                        print('rolling back @' + str(reader.offset))
-                        unknown_fragments.rollback()
-                    state = Block.UNKNOWN
-
-    unknown_fragments.eof()
-    if zip_fragment:
-        zip_fragment.mark_corrupt(reader.size)
-        zip_fragments.append(zip_fragment)
-
-    dump(zip_fragments, './partials.zips.json', primitives=True, indent=2)
-    dump(unknown_fragments, './partials.unknown.json', primitives=True, indent=2)
-    return [zip_fragments, unknown_fragments]
+                self.__end_block()
+
+    def __persist_partial(self) -> None:
+        print('persisting partial zip fragment')
+        self.__zip_fragment.mark_corrupt(self.__reader.offset)
+        self.__sink.add_zip(self.__zip_fragment.__json_encode__())
+
+    def __file_header(self) -> None:
+        reader = self.__reader
+        self.__header_buffer.clear()
+        self.__unknown_fragments.undo_header()
+        self.__block_start = reader.offset - 4 # include header
+        if self.__state != Block.FILE:
+            # start of zip file
+            if self.__state != Block.UNKNOWN:
+                print('unexpected FILE state from ' + str(self.__state) + ' @' + str(reader.offset))
+            self.__state = Block.FILE
+            if self.__zip_fragment is not None:
+                self.__persist_partial()
+            self.__zip_fragment = ZipFragment()
+        reader.seek(6, 1) # o+10
+        lm_time = int.from_bytes(reader.read(2), "little")
+        lm_date = int.from_bytes(reader.read(2), "little")
+        reader.seek(4, 1) # o+18
+        compressed_len = int.from_bytes(reader.read(4), "little")
+        reader.seek(4, 1) # o+26
+        name_len = int.from_bytes(reader.read(2), "little")
+        ext_len = int.from_bytes(reader.read(2), "little")
+        name = reader.read(name_len).decode("utf-8", "replace")
+        reader.seek(ext_len + compressed_len, 1) # to end of block
+        file = ZipFileFragment(self.__block_start, reader.offset, name, [lm_date, lm_time])
+        self.__zip_fragment.add_file(file)
+
+    def __dir_header(self) -> None:
+        reader = self.__reader
+        self.__header_buffer.clear()
+        self.__unknown_fragments.undo_header()
+        self.__block_start = reader.offset - 4 # include header
+        if self.__state != Block.DIR:
+            # start of central directory structure
+            if self.__state != Block.FILE:
+                print('unexpected DIR state from ' + str(self.__state) + ' @' + str(reader.offset))
+                if self.__zip_fragment is not None:
+                    self.__persist_partial()
+                self.__zip_fragment = ZipFragment()
+            self.__state = Block.DIR
+        reader.seek(8, 1) # o+12
+        lm_time = int.from_bytes(reader.read(2), "little")
+        lm_date = int.from_bytes(reader.read(2), "little")
+        reader.seek(4, 1) # o+20
+        compressed_len = int.from_bytes(reader.read(4), "little")
+        reader.seek(4, 1) # o+28
+        name_len = int.from_bytes(reader.read(2), "little")
+        ext_len = int.from_bytes(reader.read(2), "little")
+        com_len = int.from_bytes(reader.read(2), "little")
+        reader.seek(8, 1) # o+42
+        relative_file_start = int.from_bytes(reader.read(4), "little")
+        relative_file_end = relative_file_start + compressed_len
+        name = reader.read(name_len).decode("utf-8", "replace")
+        reader.seek(ext_len + com_len, 1) # to end of block
+        zip_dir = ZipDirFragment(self.__block_start, reader.offset, name,
+            [lm_date, lm_time], [relative_file_start, relative_file_end])
+        self.__zip_fragment.add_dir(zip_dir)
+
+    def __eof_header(self) -> None:
+        reader = self.__reader
+        self.__header_buffer.clear()
+        self.__unknown_fragments.undo_header()
+        self.__block_start = reader.offset - 4 # include header
+        if self.__state != Block.DIR:
+            # start of end of file header, there is only one
+            print('unexpected EOF state from ' + str(self.__state) + ' @' + str(reader.offset))
+            if self.__zip_fragment is not None:
+                self.__persist_partial()
+            self.__zip_fragment = ZipFragment()
+        self.__state = Block.EOF
+        reader.seek(6, 1) # o+10
+        dir_count = int.from_bytes(reader.read(2), "little")
+        dir_size = int.from_bytes(reader.read(4), "little")
+        dir_offset = int.from_bytes(reader.read(4), "little")
+        dir_start = self.__block_start - dir_size
+        zip_start = dir_start - dir_offset
+        com_len = int.from_bytes(reader.read(2), "little")
+        reader.seek(com_len, 1) # to end of block
+        self.__zip_fragment.add_eof(
+            self.__block_start, reader.offset, dir_count, dir_start, zip_start)
+        print(self.__zip_fragment)
+        self.__zip_fragment.validate()
+        self.__sink.add_zip(self.__zip_fragment.__json_encode__())
+        self.__zip_fragment = None
+
+    def __end_block(self) -> None:
+        """Data following a block is not a header, so return to unknown"""
+        reader = self.__reader
+        if self.__state != Block.UNKNOWN:
+            if self.__state == Block.FILE:
+                print('partial zip @' + str(reader.offset))
+                self.__zip_fragment.likely()
+                self.__zip_fragment.mark_corrupt(reader.offset)
+                self.__sink.add_zip(self.__zip_fragment.__json_encode__())
+                self.__zip_fragment = None
+                self.__rollback()
+            elif self.__state != Block.EOF:
+                print('unexpected UNKNOWN state from '
+                    + str(self.__state) + ' @' + str(reader.offset))
+                self.__rollback()
+            self.__state = Block.UNKNOWN
+
+    def __rollback(self) -> None:
+        """Rescan from just after the last block header"""
+        self.__reader.seek(self.__block_start + 1)
+        print('rolling back @' + str(self.__reader.offset))
+        # the buffered header bytes no longer precede the offset
+        self.__header_buffer.clear()
+        self.__unknown_fragments.rollback()
+
+
+class ShardScan:
+    """Json lines files of fragments from scanning a shard of a chkdir (see scan_shard)"""
+    def __init__(
+        self, start: int, zips_filename: str, unknowns_filename: str,
+        sync_points: list[tuple[int, int, int, int]], stop: Union[tuple[int, int], None],
+        furthest: int
+    ) -> None:
+        self.start = start
+        self.zips_filename = zips_filename
+        self.unknowns_filename = unknowns_filename
+        self.sync_points = sync_points
+        self.stop = stop
+        self.furthest = furthest
+
+    def __json_encode__(self):
+        return {
+            'start': self.start,
+            'zips_filename': self.zips_filename,
+            'unknowns_filename': self.unknowns_filename,
+            'sync_points': self.sync_points,
+            'stop': self.stop,
+            'furthest': self.furthest
+        }
+
+    @staticmethod
+    def from_json(json_dict: dict) -> 'ShardScan':
+        """Decode a shard scan, see __json_encode__"""
+        stop = json_dict['stop']
+        return ShardScan(
+            json_dict['start'], json_dict['zips_filename'], json_dict['unknowns_filename'],
+            [tuple(sync_point) for sync_point in json_dict['sync_points']],
+            tuple(stop) if stop is not None else None,
+            json_dict['furthest'])
+
+    def find(self, sync_point: tuple[int, int]) -> Union[tuple[int, int], None]:
+        """Returns the (zip count, unknown count) scanned before a sync point, if it was passed"""
+        for [offset, buffered, zip_count, unknown_count] in self.sync_points:
+            if (offset, buffered) == sync_point:
+                return (zip_count, unknown_count)
+        return None
+
+def scan_shard(
+    dirname: str, start: int, end: int, out_dir: str, buffered: int = 4
+) -> ShardScan:
+    """
+    Scan a chkdir from start, as if quiet with buffered header bytes, up to the first quiet block
+    boundary at or after end (or the end of the stream), writing fragments to out_dir.
+    """
+    prefix = os.path.join(out_dir, str(start) + '.' + str(end))
+    sink = JsonLinesSink(prefix + '.zips.jsonl', prefix + '.unknown.jsonl')
+    reader = ChkDirReader(dirname, buffer_size=READ_AHEAD_SIZE, manifest=True)
+    scanner = ZipScanner(reader, start, buffered, sink)
+    stop = scanner.scan(end)
+    reader.close()
+    sink.close()
+    return ShardScan(start, sink.zips_filename, sink.unknowns_filename,
+        scanner.sync_points, stop, scanner.furthest)
+
+def merge_shards(
+    dirname: str, shards: list[ShardScan], out_dir: str, sink: FragmentSink
+) -> None:
+    """
+    Stitch shard scans (sorted by start, the first from offset zero) into the fragments of a
+    single serial scan. Each scan is continued by the shard that passed its stop point quietly;
+    if no shard did, the gap is scanned again from the stop point.
+    """
+    shard = shards[0]
+    [zip_count, unknown_count] = [0, 0]
+    while True:
+        for fragment in read_json_lines(shard.zips_filename, zip_count):
+            sink.add_zip(fragment)
+        for fragment in read_json_lines(shard.unknowns_filename, unknown_count):
+            sink.add_unknown(fragment)
+        if shard.stop is None:
+            return
+
+        [offset, buffered] = shard.stop
+        following = [scan for scan in shards if scan.start <= offset]
+        continued = following[-1].find(shard.stop) if len(following) > 1 else None
+        if continued is not None:
+            shard = following[-1]
+            [zip_count, unknown_count] = continued
+        else:
+            later = [scan.start for scan in shards if scan.start > offset]
+            print('[shard] rescanning from ' + str(offset))
+            end = later[0] if len(later) > 0 else -1
+            shard = scan_shard(dirname, offset, end, out_dir, buffered)
+            [zip_count, unknown_count] = [0, 0]
+
+def detect_zip_parallel(dirname: str, jobs: int, sink: FragmentSink) -> None:
+    """
+    Detect zips across jobs processes, adding the fragments to sink.
+    The stream is split into block aligned shards, each scanned on to the next quiet block boundary
+    past its end, so that shards can be stitched into exactly the fragments of a serial scan.
+    """
+    # warm (and check) the manifest before the workers
+    reader = ChkDirReader(dirname, manifest=True, verify=True)
+    size = reader.size
+    reader.close()
+
+    blocks = -(-size // SCAN_BLOCK_SIZE) # ceil
+    shard_blocks = max(1, -(-blocks // (jobs * SHARDS_PER_JOB)))
+    starts = list(range(0, max(size, 1), shard_blocks * SCAN_BLOCK_SIZE))
+    ends = starts[1:] + [-1]
+    with tempfile.TemporaryDirectory(dir='.') as out_dir:
+        with ProcessPoolExecutor(jobs) as executor:
+            shards = list(map_measured(executor, scan_shard,
+                [dirname] * len(starts), starts, ends, [out_dir] * len(starts)))
+        merge_shards(dirname, shards, out_dir, sink)
+
+def chunk_units(chunks: list[tuple[str, int, int, int]]) -> list[tuple[int, int]]:
+    """Group chunk files into consecutive [start, end) runs of at least INCREMENTAL_UNIT_SIZE"""
+    units: list[tuple[int, int]] = []
+    unit_start = 0
+    for [_, _, end, _] in chunks:
+        if end - unit_start >= INCREMENTAL_UNIT_SIZE:
+            units.append((unit_start, end))
+            unit_start = end
+    if len(chunks) > 0 and unit_start < chunks[-1][2]:
+        units.append((unit_start, chunks[-1][2]))
+    return units
+
+def chunk_keys(chunks: list[tuple[str, int, int, int]], start: int, end: int) -> list[list]:
+    """(name, start, end, mtime) of the chunk files overlapping [start, end)"""
+    return [[name, chunk_start, chunk_end, mtime]
+        for [name, chunk_start, chunk_end, mtime] in chunks
+        if chunk_start < end and chunk_end > start]
+
+def detect_zip_incremental(dirname: str, jobs: int, sink: FragmentSink, cache_dirname: str) -> None:
+    """
+    Detect zips, adding the fragments to sink, re-using the scans of previous runs kept in
+    cache_dirname. Chunk files are scanned in runs (see chunk_units) and each scan is kept with the
+    names, offsets, sizes and mtimes of the chunk files it read. A run is only scanned again if
+    one of those changed: a new or modified chunk file, or one added after a scan that read to
+    the end of the directory. Runs are stitched as for parallel scans (see merge_shards).
+    """
+    # stat every chunk file, the manifest alone does not notice chunk files rewritten in place
+    reader = ChkDirReader(dirname, manifest=True, verify=True)
+    chunks = reader.chunks
+    size = reader.size
+    reader.close()
+
+    os.makedirs(cache_dirname, exist_ok=True)
+    index_filename = os.path.join(cache_dirname, 'index.json')
+    try:
+        with open(index_filename, 'r') as file:
+            index: dict = json.load(file)
+    except (OSError, ValueError):
+        index = {}
+
+    cached: dict[str, dict] = {}
+    missing: list[tuple[int, int]] = []
+    for [start, end] in chunk_units(chunks):
+        key = str(start) + '.' + str(end)
+        entry = index.get(key)
+        if (entry is not None and entry['chunks'] == chunk_keys(chunks, start, end)
+            and entry['read'] == chunk_keys(chunks, start, entry['shard']['furthest'])
+            and (entry['shard']['stop'] is not None or entry['shard']['furthest'] == size)):
+            cached[key] = entry
+        else:
+            missing.append((start, end))
+    print('[incremental] ' + str(len(cached)) + ' cached, ' + str(len(missing)) + ' to scan')
+
+    for [key, entry] in index.items():
+        if key not in cached:
+            for filename in [entry['shard']['zips_filename'], entry['shard']['unknowns_filename']]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    if len(missing) > 0:
+        with ProcessPoolExecutor(jobs) as executor:
+            starts = [start for [start, _] in missing]
+            ends = [end if end < size else -1 for [_, end] in missing]
+            scans = map_measured(executor, scan_shard,
+                [dirname] * len(missing), starts, ends, [cache_dirname] * len(missing))
+            for [[start, end], shard] in zip(missing, scans):
+                cached[str(start) + '.' + str(end)] = {
+                    'chunks': chunk_keys(chunks, start, end),
+                    'read': chunk_keys(chunks, start, shard.furthest),
+                    'shard': shard.__json_encode__()
+                }
+    with open(index_filename, 'w') as file:
+        json.dump(cached, file)
+
+    shards = [ShardScan.from_json(entry['shard']) for entry in cached.values()]
+    shards.sort(key=lambda shard: shard.start)
+    with tempfile.TemporaryDirectory(dir='.') as out_dir:
+        merge_shards(dirname, shards, out_dir, sink)
+
+def detect_zip(
+    dirname: str, jobs: int = 1, resume: bool = False, incremental: bool = False
+) -> None:
+    """
+    Given a directory of .CHK files return:
+     - ./partials.zips.json : json encoded zip ranges (see ZipFragment)
+     - ./partials.unknown.json : json encoded unknown ranges (see UnknownFragments)
+     - ./partials.catalog.sqlite : both, indexed for querying (see Catalog)
+    See ./scripts/complete.js for ways of working with this data.
+    Fragments are streamed to ./partials.zips.jsonl and ./partials.unknown.jsonl as they are
+    detected, and converted once the scan completes.
+    With jobs > 1 the directory is scanned in parallel, with the same results.
+    Otherwise progress is checkpointed to ./partials.checkpoint, and with resume an interrupted
+    scan continues from its last checkpoint.
+    With incremental only chunk files changed since the last incremental run are scanned again,
+    see detect_zip_incremental.
+    """
+    resume = resume and jobs <= 1 and not incremental and os.path.exists(CHECKPOINT_FILENAME)
+    sink = JsonLinesSink(ZIPS_FILENAME + 'l', UNKNOWNS_FILENAME + 'l', append=resume)
+    with METRICS.timer('detect_zip.scan'):
+        if incremental:
+            detect_zip_incremental(dirname, max(jobs, 1), sink, INCREMENTAL_DIRNAME)
+        elif jobs > 1:
+            detect_zip_parallel(dirname, jobs, sink)
+        else:
+            # read/seek, checkpoints fingerprint every chunk file so verify the manifest up front
+            reader = ChkDirReader(dirname, buffer_size=READ_AHEAD_SIZE, manifest=True, verify=True)
+            scanner = ZipScanner(reader, sink=sink)
+            if resume:
+                scanner.restore_checkpoint(CHECKPOINT_FILENAME)
+            scanner.enable_checkpoints(CHECKPOINT_FILENAME)
+            scanner.scan()
+            print('[buffer]: ' + str(reader.buffer_stats))
+            reader.close()
+            if os.path.exists(CHECKPOINT_FILENAME):
+                os.remove(CHECKPOINT_FILENAME) # completed
+        sink.close()
+    METRICS.count('detect_zip.zips', sink.zip_count)
+    METRICS.count('detect_zip.unknowns', sink.unknown_count)
+
+    json_lines_to_json(sink.zips_filename, ZIPS_FILENAME)
+    json_lines_to_json(sink.unknowns_filename, UNKNOWNS_FILENAME)
+    catalog = Catalog(CATALOG_FILENAME)
+    catalog.add_fragments(
+        read_json_lines(sink.zips_filename), read_json_lines(sink.unknowns_filename))
+    catalog.close()
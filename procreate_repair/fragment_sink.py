@@ -0,0 +1,95 @@
+"""Destinations for detected fragments"""
+import json
+
+
+class FragmentSink:
+    """Receives json encoded fragments as they are closed, collecting them in memory"""
+    def __init__(self) -> None:
+        self.zips: list[dict] = []
+        self.unknowns: list[dict] = []
+        self.zip_count: int = 0
+        self.unknown_count: int = 0
+
+    def add_zip(self, fragment: dict) -> None:
+        """Add a closed zip fragment"""
+        self.zip_count += 1
+        self.zips.append(fragment)
+
+    def add_unknown(self, fragment: dict) -> None:
+        """Add a closed unknown fragment"""
+        self.unknown_count += 1
+        self.unknowns.append(fragment)
+
+    def checkpoint(self) -> dict:
+        """State needed to restore the sink to this point"""
+        return { 'zip_count': self.zip_count, 'unknown_count': self.unknown_count }
+
+    def restore(self, checkpoint: dict) -> None:
+        """Discard fragments added since checkpoint"""
+        self.zip_count = checkpoint['zip_count']
+        self.unknown_count = checkpoint['unknown_count']
+        del self.zips[self.zip_count:]
+        del self.unknowns[self.unknown_count:]
+
+    def close(self) -> None:
+        """Finish receiving fragments"""
+
+
+class JsonLinesSink(FragmentSink):
+    """
+    Appends json encoded fragments to json lines files, one fragment per line, as they close.
+    Files are truncated unless append is set, for example to restore a checkpoint.
+    """
+    def __init__(self, zips_filename: str, unknowns_filename: str, append: bool = False) -> None:
+        super().__init__()
+        self.zips_filename = zips_filename
+        self.unknowns_filename = unknowns_filename
+        mode = 'a' if append else 'w'
+        self.__zips_file = open(zips_filename, mode) # pylint: disable=consider-using-with
+        self.__unknowns_file = open(unknowns_filename, mode) # pylint: disable=consider-using-with
+
+    def add_zip(self, fragment: dict) -> None:
+        self.zip_count += 1
+        self.__zips_file.write(json.dumps(fragment) + '\n')
+
+    def add_unknown(self, fragment: dict) -> None:
+        self.unknown_count += 1
+        self.__unknowns_file.write(json.dumps(fragment) + '\n')
+
+    def checkpoint(self) -> dict:
+        self.__zips_file.flush()
+        self.__unknowns_file.flush()
+        checkpoint = super().checkpoint()
+        checkpoint['zips_size'] = self.__zips_file.tell()
+        checkpoint['unknowns_size'] = self.__unknowns_file.tell()
+        return checkpoint
+
+    def restore(self, checkpoint: dict) -> None:
+        super().restore(checkpoint)
+        self.__zips_file.truncate(checkpoint['zips_size'])
+        self.__unknowns_file.truncate(checkpoint['unknowns_size'])
+
+    def close(self) -> None:
+        self.__zips_file.close()
+        self.__unknowns_file.close()
+
+
+def read_json_lines(filename: str, skip: int = 0):
+    """Iterate the fragments of a json lines file, skipping the first skip lines"""
+    with open(filename, 'r') as file:
+        for index, line in enumerate(file):
+            if index >= skip:
+                yield json.loads(line)
+
+def json_lines_to_json(jsonl_filename: str, json_filename: str) -> None:
+    """
+    Convert a json lines file to a json array file, one fragment at a time.
+    Output matches json.dump(fragments, file, indent=2), the layout expected downstream.
+    """
+    with open(json_filename, 'w') as file:
+        empty = True
+        for fragment in read_json_lines(jsonl_filename):
+            file.write('[\n  ' if empty else ',\n  ')
+            file.write(json.dumps(fragment, indent=2).replace('\n', '\n  '))
+            empty = False
+        file.write('[]' if empty else '\n]')
@@ -1,10 +1,15 @@
 """Layer utilities"""
 import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
 from zipfile import ZipFile
 
 import lzo
+import numpy as np
 from PIL import Image
 
+from .metrics import METRICS
+
 # this code owes an incredible amount to:
 #  - https://github.com/jaromvogel/ProcreateViewer
 #  - https://github.com/redstrate/procreate-viewer
@@ -16,8 +21,11 @@ def process_chunk(
     columns: int, rows: int,
     difference_x: int, difference_y: int,
     strict: bool
-) -> tuple[Image.Image, tuple[int, int]]:
-    """iterate through chunks, decompress them, create images"""
+) -> Union[tuple[np.ndarray, tuple[int, int]], None]:
+    """
+    Decompress a chunk to a (height, width, rgba) tile of pixel rows, bottom row first, and the
+    pixel position of its top left corner on the canvas
+    """
     # Get row and column from filename
     column = int(chunk_name.strip('.chunk').split('~')[0])
     row = int(chunk_name.strip('.chunk').split('~')[1]) + 1
@@ -34,16 +42,17 @@ def process_chunk(
 
     try:
         # read the actual data and create an image
-        file = archive.read(layer_id + '/' + chunk_name)
+        with METRICS.timer('layer.read'): # includes inflating
+            file = archive.read(layer_id + '/' + chunk_name)
         # 262144 is the final byte size of the pixel data for 256x256 square.
         # This is based on 256*256*4 (width * height * 4 bytes per pixel)
         # finalsize is chunk width * chunk height * 4 bytes per pixel
         finalsize = chunk_tilesize['x'] * chunk_tilesize['y'] * 4
-        decompressed = lzo.decompress(file, False, finalsize)
+        with METRICS.timer('layer.lzo'):
+            decompressed = lzo.decompress(file, False, finalsize)
         # Will need to know how big each tile is instead of just saying 256
-        image = Image.frombytes('RGBA', (chunk_tilesize['x'],chunk_tilesize['y']), decompressed)
-        # Tile starts upside down, flip it
-        image = image.transpose(Image.FLIP_TOP_BOTTOM)
+        tile = np.frombuffer(decompressed, np.uint8, finalsize).reshape(
+            chunk_tilesize['y'], chunk_tilesize['x'], 4)
 
         # Calculate pixel position of tile
         position_x = column * tilesize
@@ -51,28 +60,78 @@ def process_chunk(
         if  row == rows:
             position_y = 0
 
-        return (image, (position_x, position_y))
+        METRICS.count('layer.tiles')
+        METRICS.maybe_report()
+        return (tile, (position_x, position_y))
     except: # pylint: disable=bare-except
+        METRICS.count('layer.failed_tiles')
         if strict:
             raise
         print("failed to decompress: " + layer_id + '/' + chunk_name)
         return None
 
+def paste_tile(canvas: np.ndarray, tile: np.ndarray, position: tuple[int, int]) -> None:
+    """Copy a tile into the canvas at position, clipped to the canvas"""
+    [position_x, position_y] = position
+    [height, width] = canvas.shape[0:2]
+    # Tile starts upside down, flip it
+    tile = tile[::-1]
+    top = max(0, -position_y)
+    left = max(0, -position_x)
+    bottom = min(tile.shape[0], height - position_y)
+    right = min(tile.shape[1], width - position_x)
+    if (bottom <= top or right <= left):
+        return # entirely off the canvas
+    rows = slice(position_y + top, position_y + bottom)
+    columns = slice(position_x + left, position_x + right)
+    canvas[rows, columns] = tile[top:bottom, left:right]
+
+def orient(canvas: np.ndarray, orientation: int, h_flipped: bool, v_flipped: bool) -> np.ndarray:
+    """
+    The canvas in the drawing's orientation, as a view, so the rotation and any flips cost a
+    single copy when the image is finally created
+    """
+    if orientation == 3:
+        canvas = np.rot90(canvas, 1)
+    elif orientation == 4:
+        canvas = np.rot90(canvas, -1)
+    elif orientation == 2:
+        canvas = np.rot90(canvas, 2)
+
+    if orientation in [1, 2]:
+        [flip_left_right, flip_top_bottom] = [h_flipped == 1, v_flipped == 1]
+    elif orientation in [3, 4]:
+        [flip_left_right, flip_top_bottom] = [v_flipped == 1, h_flipped == 1]
+    else:
+        [flip_left_right, flip_top_bottom] = [False, False]
+    if flip_left_right:
+        canvas = canvas[:, ::-1]
+    if flip_top_bottom:
+        canvas = canvas[::-1]
+    return canvas
+
 def write_layer(
     out_file: str, archive: ZipFile,
     layer_id: str,
     imagesize: tuple[int, int], tilesize: int,
     orientation: int, h_flipped: bool, v_flipped: bool,
-    strict: bool = True
+    strict: bool = True, chunk_list: Union[list[str], None] = None, jobs: int = 1
 ):
-    """Write a layer to a bitmap"""
-    # detect files
-    all_files = archive.namelist()
-    layer_files = list(filter(lambda x: layer_id in x, all_files))
-    chunk_list = list(map(lambda x: x.strip(layer_id).strip('/'), layer_files))
-
-    # create a new image
-    canvas = Image.new('RGBA', (imagesize[0], imagesize[1]))
+    """
+    Write a layer to a bitmap.
+    chunk_list names the layer's chunks (col~row.chunk), if known, otherwise they are detected.
+    With jobs > 1 tiles are read and decoded on a thread pool (zlib and lzo release the gil while
+    decompressing), so the archive's read must be thread safe, as ZipFile and ChunkArchive are.
+    Each tile still fails (strict) or is skipped (not strict) on its own.
+    """
+    if chunk_list is None:
+        # detect files
+        all_files = archive.namelist()
+        layer_files = list(filter(lambda x: layer_id in x, all_files))
+        chunk_list = list(map(lambda x: x.strip(layer_id).strip('/'), layer_files))
+
+    # create a new image, as rows of rgba pixels
+    canvas = np.zeros((imagesize[1], imagesize[0], 4), np.uint8)
 
     # Figure out how many total rows and columns there are
     columns = int(math.ceil(float(imagesize[0]) / float(tilesize)))
@@ -86,40 +145,32 @@ def write_layer(
     if imagesize[1] % tilesize != 0:
         difference_y = (rows * tilesize) - imagesize[1]
 
-    tilelist = []
-    # print(chunk_list)
-    for chunk_name in chunk_list:
-        if (chunk_name == '' and not strict):
-            continue
-        response = process_chunk(
+    if not strict:
+        chunk_list = [chunk_name for chunk_name in chunk_list if chunk_name != '']
+    def process(chunk_name: str) -> Union[tuple[np.ndarray, tuple[int, int]], None]:
+        return process_chunk(
             archive,
             layer_id, chunk_name,
             imagesize, tilesize,
             columns, rows,
             difference_x, difference_y,
             strict)
-        if response is not None:
-            tilelist.append(response)
+
+    # print(chunk_list)
+    if jobs > 1:
+        with ThreadPoolExecutor(jobs) as executor:
+            responses = list(executor.map(process, chunk_list))
+    else:
+        responses = [process(chunk_name) for chunk_name in chunk_list]
+    tilelist = [response for response in responses if response is not None]
 
     # Add each tile to composite image
     for tile in tilelist:
-        canvas.paste(tile[0], tile[1])
+        paste_tile(canvas, tile[0], tile[1])
 
     # Make sure the image appears in the correct orientation
-    if orientation == 3:
-        canvas = canvas.rotate(90, expand=True)
-    elif orientation == 4:
-        canvas = canvas.rotate(-90, expand=True)
-    elif orientation == 2:
-        canvas = canvas.rotate(180, expand=True)
-
-    if h_flipped == 1 and (orientation == 1 or orientation == 2):
-        canvas = canvas.transpose(Image.FLIP_LEFT_RIGHT)
-    if h_flipped == 1 and (orientation == 3 or orientation == 4):
-        canvas = canvas.transpose(Image.FLIP_TOP_BOTTOM)
-    if v_flipped == 1 and (orientation == 1 or orientation == 2):
-        canvas = canvas.transpose(Image.FLIP_TOP_BOTTOM)
-    if v_flipped == 1 and (orientation == 3 or orientation == 4):
-        canvas = canvas.transpose(Image.FLIP_LEFT_RIGHT)
-
-    canvas.save(out_file)
+    image = Image.fromarray(np.ascontiguousarray(orient(canvas, orientation, h_flipped, v_flipped)))
+
+    with METRICS.timer('layer.png'):
+        image.save(out_file)
+    METRICS.count('layer.layers')
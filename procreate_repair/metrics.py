@@ -0,0 +1,118 @@
+"""Performance counters and timers for the recovery pipeline"""
+import json
+import threading
+import time
+from concurrent.futures import Executor
+from itertools import repeat
+from typing import Any, Callable, Iterator, Union
+
+REPORT_INTERVAL = 5.0 # minimum seconds between reports to a callback
+
+class Timer:
+    """Adds the time spent in a with block to a named timer"""
+    def __init__(self, metrics: 'Metrics', name: str) -> None:
+        self.__metrics = metrics
+        self.__name = name
+        self.__start = 0.0
+
+    def __enter__(self) -> 'Timer':
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.__metrics.add_time(self.__name, time.perf_counter() - self.__start)
+
+class Metrics:
+    """
+    Named counters (bytes read, seeks, tiles...) and timers (seconds spent inflating, decoding...).
+    Counters are locked dict updates, so are cheap enough to bump per read (from any thread);
+    reports are built only on request, or for a callback at most every interval seconds from the
+    (coarse) places the pipeline calls maybe_report. Each process has its own metrics (see METRICS),
+    process pools return their workers' metrics to be merged with map_measured.
+    """
+    def __init__(self) -> None:
+        self.__counters: dict[str, int] = {}
+        self.__timers: dict[str, float] = {}
+        self.__started = time.perf_counter()
+        self.__callback: Union[Callable[[dict], None], None] = None
+        self.__interval = REPORT_INTERVAL
+        self.__reported = self.__started
+        self.__lock = threading.Lock()
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Add to a counter"""
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def add_time(self, name: str, seconds: float) -> None:
+        """Add to a timer"""
+        with self.__lock:
+            self.__timers[name] = self.__timers.get(name, 0.0) + seconds
+
+    def timer(self, name: str) -> Timer:
+        """Time a with block, e.g. with METRICS.timer('deflate.inflate'): ..."""
+        return Timer(self, name)
+
+    def merge(self, report: dict) -> None:
+        """Add the counters and timers of a report, e.g. from a pool worker"""
+        with self.__lock:
+            for [name, value] in report['counters'].items():
+                self.__counters[name] = self.__counters.get(name, 0) + value
+            for [name, seconds] in report['timers'].items():
+                self.__timers[name] = self.__timers.get(name, 0.0) + seconds
+
+    def reset(self) -> None:
+        """Clear all counters and timers"""
+        self.__counters.clear()
+        self.__timers.clear()
+        self.__started = time.perf_counter()
+        self.__reported = self.__started
+
+    def report(self) -> dict:
+        """
+        Counters, timers (seconds) and counter rates (per second of elapsed time).
+        Timers merged from parallel workers are summed, so may exceed the elapsed time.
+        """
+        elapsed = time.perf_counter() - self.__started
+        return {
+            'elapsed': elapsed,
+            'counters': dict(self.__counters),
+            'timers': dict(self.__timers),
+            'rates': { name: value / elapsed for [name, value] in self.__counters.items() }
+                if elapsed > 0 else {}
+        }
+
+    def write_report(self, filename: str) -> None:
+        """Write a json report"""
+        with open(filename, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+    def on_report(
+        self, callback: Union[Callable[[dict], None], None], interval: float = REPORT_INTERVAL
+    ) -> None:
+        """Call callback with a report at most every interval seconds, None to stop"""
+        self.__callback = callback
+        self.__interval = interval
+
+    def maybe_report(self) -> None:
+        """Report to the callback, if any, when interval has elapsed since the last report"""
+        if self.__callback is None:
+            return
+        now = time.perf_counter()
+        if now - self.__reported >= self.__interval:
+            self.__reported = now
+            self.__callback(self.report())
+
+METRICS = Metrics()
+
+def measured(function: Callable, *args) -> tuple[Any, dict]:
+    """Call function in a pool worker, returning its result and the metrics it recorded"""
+    METRICS.reset() # workers are reused, and may be forked with the parent's metrics
+    result = function(*args)
+    return (result, METRICS.report())
+
+def map_measured(executor: Executor, function: Callable, *iterables) -> Iterator:
+    """As executor.map, merging the metrics each call recorded in its worker into METRICS"""
+    for [result, report] in executor.map(measured, repeat(function), *iterables):
+        METRICS.merge(report)
+        yield result
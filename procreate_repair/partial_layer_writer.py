@@ -1,29 +1,33 @@
 """Render a partially recovered procreate layer."""
 import json
 import math
+import os
+import re
 import zlib
 
 import lzo
 
+from .catalog import Catalog
 from .chkdir import ChkDirReader
+from .deflate import entry_data_start
 from .layer_writer import write_layer
+from .metrics import METRICS
 
 MAX_BUFFER_LEN = 512*512*4 # posit largest size
 
 def deflate_range(reader: ChkDirReader, start: int, end: int, allow_error: bool = False) -> bytes:
-    """Deflate a chkdir range to memory."""
-    reader.seek(start + 26)
-    name_len = int.from_bytes(reader.read(2), "little")
-    ext_len = int.from_bytes(reader.read(2), "little")
-    reader.seek(name_len + ext_len, 1)
-
-    size = end - reader.offset
-    data = reader.read(size)
-
+    """Deflate a chkdir range to memory, safe to call from multiple threads (see read_at)."""
     try:
-        decompress = zlib.decompressobj(-zlib.MAX_WBITS)
-        deflated = decompress.decompress(data)
-        deflated += decompress.flush()
+        offset = entry_data_start(reader, start)
+        size = end - offset
+        data = reader.read_at(offset, size)
+        with METRICS.timer('deflate.inflate'):
+            decompress = zlib.decompressobj(-zlib.MAX_WBITS)
+            deflated = decompress.decompress(data)
+            deflated += decompress.flush()
+        METRICS.count('deflate.ranges')
+        METRICS.count('deflate.bytes_in', size)
+        METRICS.count('deflate.bytes_out', len(deflated))
         return deflated
     except: # pylint: disable=bare-except
         if allow_error:
@@ -56,6 +60,11 @@ def chunk_ranges_from_json(filename: str) -> list[ChunkRange]:
             chunks.append(chunk)
     return chunks
 
+def chunk_ranges_from_catalog(catalog: Catalog, layer: str) -> list[ChunkRange]:
+    """Loads the intact chunk ranges of a layer (uuid/[date, time]) from a detect_zip catalog"""
+    return [ChunkRange(entry['name'], entry['start'], entry['end'])
+        for entry in catalog.entries(layer=layer, intact=True)]
+
 
 def get_tile_size(reader: ChkDirReader, chunks: list[ChunkRange]) -> int:
     """Gets the size of a square tile from an unknown chunk"""
@@ -64,7 +73,8 @@ def get_tile_size(reader: ChkDirReader, chunks: list[ChunkRange]) -> int:
         if  data is None:
             continue
         try:
-            decompressed: bytes = lzo.decompress(data, False, MAX_BUFFER_LEN)
+            with METRICS.timer('layer.lzo'):
+                decompressed: bytes = lzo.decompress(data, False, MAX_BUFFER_LEN)
             pixel_count: float = len(decompressed) / 4 # RGBA per-pixel
             tilesize = math.sqrt(pixel_count) # square edge length
             return int(tilesize)
@@ -79,7 +89,8 @@ def get_edge_size(reader: ChkDirReader, chunks: list[ChunkRange], tilesize: int)
         if data is None:
             continue
         try:
-            decompressed: bytes = lzo.decompress(data, False, MAX_BUFFER_LEN)
+            with METRICS.timer('layer.lzo'):
+                decompressed: bytes = lzo.decompress(data, False, MAX_BUFFER_LEN)
             pixel_count: float = len(decompressed) / 4 # RGBA per-pixel
             edge_length = pixel_count / tilesize # rect edge length
             return int(edge_length)
@@ -92,6 +103,7 @@ class ChunkArchive:
     def __init__(self, reader: ChkDirReader, chunks: list[ChunkRange]) -> None:
         self.__reader = reader
         self.__chunks = chunks
+        self.__chunks_by_name = { chunk.name: chunk for chunk in chunks } # last duplicate wins
 
     def namelist(self) -> list[str]:
         """A list of all the file names in the archive."""
@@ -102,17 +114,16 @@ class ChunkArchive:
 
     def read(self, filename: str) -> bytes:
         """Return a deflated file by name"""
-        the_chunk = None
-        for chunk in self.__chunks:
-            if chunk.name == filename:
-                the_chunk = chunk
+        the_chunk = self.__chunks_by_name.get(filename)
         if the_chunk is None:
             raise FileNotFoundError(filename)
         return deflate_range(self.__reader, the_chunk.start, the_chunk.end, True)
 
 
-def write_partial_layer(out_file: str, reader: ChkDirReader, chunks: list[ChunkRange]):
-    """Write a partial layer from a chunk archive"""
+def write_partial_layer(
+    out_file: str, reader: ChkDirReader, chunks: list[ChunkRange], jobs: int = 1
+):
+    """Write a partial layer from a chunk archive, decoding tiles with jobs threads"""
     archive = ChunkArchive(reader, chunks)
     layer_id = chunks[0].layer_id
 
@@ -192,10 +203,10 @@ def write_partial_layer(out_file: str, reader: ChkDirReader, chunks: list[ChunkR
         layer_id,
         imagesize, tilesize,
         orientation, h_flipped, v_flipped,
-        False
+        False, jobs=jobs
     )
 
-def recover_manifest(filename: str, reader: ChkDirReader, start: int = 0):
+def recover_manifest(filename: str, reader: ChkDirReader, start: int = 0, jobs: int = 1):
     """
     Given a manifest json file of [filename] pointing to layer files of [{ name, start, end }],
     return all the layers rendered as .png.
@@ -208,5 +219,41 @@ def recover_manifest(filename: str, reader: ChkDirReader, start: int = 0):
         chunks = chunk_ranges_from_json(chunk_file)
         out_file = chunk_file.replace('/json/', '/png/').replace('.json', '.png')
         print('manifest no: ' + str(index) + "/" + str(len(manifest)))
-        write_partial_layer(out_file, reader, chunks)
+        write_partial_layer(out_file, reader, chunks, jobs)
+        METRICS.count('layer.partial_layers')
+        index += 1
+
+def recover_catalog(
+    catalog_filename: str, reader: ChkDirReader, out_dir: str, start: int = 0, jobs: int = 1
+):
+    """As recover_manifest, but for the layers of a detect_zip catalog, written to out_dir"""
+    catalog = Catalog(catalog_filename)
+    layers = catalog.layers()[start:]
+    index = start
+    for layer in layers:
+        chunks = chunk_ranges_from_catalog(catalog, layer)
+        print('layer no: ' + str(index) + "/" + str(len(layers)))
+        index += 1
+        if len(chunks) == 0:
+            print(' > empty layer ' + layer)
+            continue
+        out_file = os.path.join(out_dir, re.sub(r'(/\[|, |\])', '_', layer) + '.png')
+        write_partial_layer(out_file, reader, chunks, jobs)
+        METRICS.count('layer.partial_layers')
+    catalog.close()
+
+def recover_layers(
+    layers: dict[str, list[dict]], reader: ChkDirReader, out_dir: str, jobs: int = 1
+):
+    """
+    As recover_manifest, but for { layer id: [{ name, start, end }] } ranges already in memory
+    (see complete.Analysis.layer_ranges), written to out_dir
+    """
+    index = 0
+    for [layer_id, ranges] in layers.items():
+        chunks = [ChunkRange(spec['name'], spec['start'], spec['end']) for spec in ranges]
+        out_file = os.path.join(out_dir, re.sub(r'(/\[|, |\])', '_', layer_id) + '.png')
+        print('layer no: ' + str(index) + "/" + str(len(layers)))
+        write_partial_layer(out_file, reader, chunks, jobs)
+        METRICS.count('layer.partial_layers')
         index += 1
@@ -1,131 +1,263 @@
 """A procreate drawing"""
 import json
+import os
 import plistlib
 import re
+import shutil
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 from io import BytesIO
+from typing import BinaryIO, Union
 
 from .layer_writer import write_layer
+from .rebuild_zip import FLAG_DATA_DESCRIPTOR, FLAG_UTF8, LOCAL_HEADER, ZIP_MAX
 from .utils import uid_convert
 
+UUID = re.compile(
+    r"\b[0-9a-f]{8}\b-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-\b[0-9a-f]{12}\b", re.IGNORECASE)
+VALIDATE_READ_SIZE = 2**20 # decompressed bytes read per step of a deep check
+COPY_SIZE = 2**20 # bytes copied per read by write_file
 
 class ProcreateDrawing:
-    """A procreate drawing"""
-    def __init__(self, data: BytesIO) -> None:
+    """
+    A procreate drawing.
+    Document.archive is only parsed when a field is first needed, and each field is resolved once,
+    so bulk triage of many drawings only pays for the fields it uses.
+    """
+    def __init__(self, data: Union[BytesIO, BinaryIO]) -> None:
+        """data is a seekable file of the zip, such as BytesIO or a chkdir buffered_range"""
         self.__raw = data
         archive = zipfile.ZipFile(data, 'r')
         self.data = archive
-        plist_data = archive.read('Document.archive')
-        plist = plistlib.loads(plist_data)
-        self.plist = plist
-        self.__objects = self.plist.get('$objects')
-        self.__root_object = self.__objects[1]
 
-    @property
+    @cached_property
+    def plist(self) -> dict:
+        """Parsed Document.archive"""
+        plist_data = self.data.read('Document.archive')
+        return plistlib.loads(plist_data)
+
+    @cached_property
+    def __objects(self) -> list:
+        return self.plist.get('$objects')
+
+    @cached_property
+    def __root_object(self) -> dict:
+        return self.__objects[1]
+
+    def __resolve(self, ref: plistlib.UID):
+        """Object referenced by a uid"""
+        return self.__objects[ref.data]
+
+    @cached_property
     def tile_size(self) -> int:
         """Drawing tile size"""
         return self.__root_object.get('tileSize')
-    @property
+    @cached_property
     def orientation(self) -> int:
         """Drawing orientation"""
         return self.__root_object.get('orientation')
-    @property
+    @cached_property
     def name(self) -> str:
         """Drawing name"""
-        name_ref = self.__root_object.get('name').data
-        return self.__objects[name_ref]
-    @property
+        return self.__resolve(self.__root_object.get('name'))
+    @cached_property
     def flipped_horizontally(self) -> bool:
         """If true drawing is flipped horizontally"""
         return self.__root_object.get('flippedHorizontally')
-    @property
+    @cached_property
     def composite_uuid(self) -> str:
         """Uuid of the composite layer"""
-        composite_ref = self.__root_object.get('composite').data
-        uuid_ref = self.__objects[composite_ref].get('UUID')
-        return self.__objects[uuid_ref]
-    @property
-    def __image_size(self) -> list[str]:
-        size_ref = self.__root_object.get('size').data
-        image_size_string = self.__objects[size_ref]
-        image_size = image_size_string.strip('{').strip('}').split(', ')
-        return image_size
+        composite = self.__resolve(self.__root_object.get('composite'))
+        return self.__objects[composite.get('UUID')]
+    @cached_property
+    def __image_size(self) -> list[int]:
+        image_size_string = self.__resolve(self.__root_object.get('size'))
+        return [int(size) for size in image_size_string.strip('{').strip('}').split(', ')]
     @property
     def width(self) -> int:
         """Drawing width"""
-        return int(self.__image_size[0])
+        return self.__image_size[0]
     @property
     def height(self) -> int:
         """Drawing height"""
-        return int(self.__image_size[1])
-    @property
+        return self.__image_size[1]
+    @cached_property
     def flipped_vertically(self) -> bool:
         """If true drawing is flipped vertically"""
         return self.__root_object.get('flippedVertically')
-    @property
+    def __layers(self, key: str) -> list[dict]:
+        """Layer objects of a root layer list"""
+        layers = self.__resolve(self.__root_object.get(key)).get('NS.objects')
+        return [self.__resolve(layer_ref) for layer_ref in layers]
+    @cached_property
     def layer_uuids(self) -> list[str]:
         """List of layer uuids"""
-        layers_ref = self.__root_object.get('layers').data
-        layers = self.__objects[layers_ref].get('NS.objects')
-        layer_uuids = []
-        for layer_ref in layers:
-            layer = self.__objects[layer_ref.data]
-            uuid = layer.get('UUID')
-            layer_uuids.append(uuid)
-        return layer_uuids
-    @property
+        return [layer.get('UUID') for layer in self.__layers('layers')]
+    @cached_property
     def unwrapped_layer_uuids(self) -> list[str]:
         """List of layer uuids"""
-        layers_ref = self.__root_object.get('unwrappedLayers').data
-        layers = self.__objects[layers_ref].get('NS.objects')
-        layer_uuids = []
-        for layer_ref in layers:
-            layer = self.__objects[layer_ref.data]
-            uuid = layer.get('UUID')
-            layer_uuids.append(uuid)
-        return layer_uuids
-    @property
+        return [layer.get('UUID') for layer in self.__layers('unwrappedLayers')]
+    @cached_property
+    def layers_by_uuid(self) -> dict[str, dict]:
+        """Layer objects (of layers and unwrappedLayers) by uuid"""
+        layers: dict[str, dict] = {}
+        for key in ['layers', 'unwrappedLayers']:
+            if self.__root_object.get(key) is not None:
+                for layer in self.__layers(key):
+                    uuid = layer.get('UUID')
+                    if isinstance(uuid, plistlib.UID):
+                        uuid = self.__resolve(uuid)
+                    layers.setdefault(uuid, layer)
+        return layers
+    @cached_property
     def all_uuids(self) -> list[str]:
         """List of all the uuids referenced"""
-        uuids = []
-        for obj in self.__objects:
-            if isinstance(obj, str):
-                is_uuid = re.fullmatch(
-                    r"\b[0-9a-f]{8}\b-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-\b[0-9a-f]{12}\b",
-                    obj, flags=re.IGNORECASE)
-                if is_uuid:
-                    uuids.append(obj)
-        return uuids
-
-    def validate(self) -> bool:
-        """Validates all referenced data exists"""
-        uuids = self.all_uuids
-        print("testing for " + str(len(uuids)) + " resources")
-        all_files = self.data.namelist()
-        missing_count = 0
-        for uuid in uuids:
-            for file in all_files:
-                if uuid in file: # only layer file
-                    try:
-                        self.data.read(file)
-                    except IOError:
-                        print('missing uuid: ' + uuid)
-                        missing_count += 1
-        return missing_count == 0
+        return [obj for obj in self.__objects if isinstance(obj, str) and UUID.fullmatch(obj)]
+    @cached_property
+    def entries_by_uuid(self) -> dict[str, list[str]]:
+        """Names of the zip entries (e.g. layer chunks) including each uuid"""
+        entries: dict[str, list[str]] = {}
+        for file in self.data.namelist():
+            for uuid in set(UUID.findall(file)):
+                entries.setdefault(uuid, []).append(file)
+        return entries
+
+    def __check_header( # pylint: disable=too-many-return-statements
+        self, info: zipfile.ZipInfo
+    ) -> tuple[Union[str, None], str]:
+        """
+        (status, error) of an entry's local header against its central directory record, status
+        is None when they agree, missing without a local header or data, otherwise corrupt
+        """
+        raw = self.__raw
+        size = raw.seek(0, 2)
+        raw.seek(info.header_offset)
+        header = raw.read(LOCAL_HEADER.size)
+        if len(header) < LOCAL_HEADER.size:
+            return ('missing', 'truncated local header')
+        [signature, _, flags, method, _, _, crc, compressed_len, _, name_len, ext_len] = (
+            LOCAL_HEADER.unpack(header))
+        if signature != b'PK\x03\x04':
+            return ('missing', 'no local header at ' + str(info.header_offset))
+        name = raw.read(name_len).decode('utf-8' if flags & FLAG_UTF8 else 'cp437', 'replace')
+        if name != info.orig_filename:
+            return ('missing', 'local header is for ' + name)
+        if method != info.compress_type:
+            return ('corrupt', 'compression method ' + str(method) + ' disagrees')
+        if not flags & FLAG_DATA_DESCRIPTOR:
+            # otherwise the local crc and sizes are deferred to a data descriptor
+            if crc != info.CRC:
+                return ('corrupt', 'crc ' + str(crc) + ' disagrees')
+            if compressed_len not in [info.compress_size, ZIP_MAX]:
+                return ('corrupt', 'compressed size ' + str(compressed_len) + ' disagrees')
+        data_end = info.header_offset + LOCAL_HEADER.size + name_len + ext_len + info.compress_size
+        if data_end > size:
+            return ('missing', 'data truncated by ' + str(data_end - size) + ' bytes')
+        return (None, '')
+
+    def __check_data(self, info: zipfile.ZipInfo) -> Union[str, None]:
+        """Error decompressing an entry, or with its crc, streamed in VALIDATE_READ_SIZE pieces"""
+        try:
+            with self.data.open(info) as file:
+                while len(file.read(VALIDATE_READ_SIZE)) > 0:
+                    pass
+        except (zipfile.BadZipFile, zlib.error, EOFError, OSError) as error:
+            return str(error)
+        return None
+
+    def check(self, mode: str = 'quick', jobs: int = 1) -> list[dict]:
+        """
+        Check the zip entries of every referenced uuid, returning [{ uuid, file, status, error }]
+        for each entry found missing or corrupt. quick compares local headers (including crc) with
+        the central directory, deep also decompresses and crc checks the data using jobs threads.
+        """
+        if mode not in ['quick', 'deep']:
+            raise Exception("Unknown validation mode: " + mode)
+        files: dict[str, str] = {} # entries are checked once, under the first uuid referencing them
+        for uuid in self.all_uuids:
+            for file in self.entries_by_uuid.get(uuid, []):
+                files.setdefault(file, uuid)
+
+        problems: list[dict] = []
+        consistent: list[tuple[str, zipfile.ZipInfo]] = []
+        for [file, uuid] in files.items():
+            info = self.data.getinfo(file)
+            [status, error] = self.__check_header(info)
+            if status is None:
+                consistent.append((uuid, info))
+            else:
+                problems.append({ 'uuid': uuid, 'file': file, 'status': status, 'error': error })
+        if mode == 'deep':
+            with ThreadPoolExecutor(jobs) as executor:
+                errors = list(executor.map(self.__check_data, [info for [_, info] in consistent]))
+            for [[uuid, info], error] in zip(consistent, errors):
+                if error is not None:
+                    problems.append({ 'uuid': uuid, 'file': info.filename, 'status': 'corrupt',
+                        'error': error })
+        return problems
+
+    def validate(self, mode: str = 'deep', jobs: int = 1) -> bool:
+        """Validates all referenced data exists (see check)"""
+        print("testing for " + str(len(self.all_uuids)) + " resources")
+        problems = self.check(mode, jobs)
+        for problem in problems:
+            print(problem['status'] + ' uuid: ' + problem['uuid'] + ' ' + problem['file'] + ' '
+                + problem['error'])
+        return len(problems) == 0
 
     def write_file(self, path):
         """Dump procreate to the file"""
+        self.__raw.seek(0)
         with open(path, 'xb') as file:
-            file.write(self.__raw.getbuffer())
+            shutil.copyfileobj(self.__raw, file, COPY_SIZE)
+
+    def __chunk_list(self, layer_id: str) -> list[str]:
+        """Chunk names (col~row.chunk) of a layer, from the uuid index"""
+        prefix = layer_id + '/'
+        return [file[len(prefix):] for file in self.entries_by_uuid.get(layer_id, [])
+            if file.startswith(prefix) and len(file) > len(prefix)]
 
-    def write_layer(self, layer_id, out_file):
-        """Write a layer to disk"""
+    def write_layer(self, layer_id, out_file, jobs: int = 1):
+        """Write a layer to disk, decoding tiles with jobs threads"""
         return write_layer(
             out_file, self.data, layer_id,
             [self.width, self.height], self.tile_size,
             self.orientation, self.flipped_horizontally, self.flipped_vertically,
+            chunk_list=self.__chunk_list(layer_id), jobs=jobs
         )
 
+    def write_all_layers(self, out_dir: str, jobs: int = 1, strict: bool = True) -> dict[str, str]:
+        """
+        Write the composite and every layer with chunks to [out_dir]/[uuid].png, rendering jobs
+        layers at a time on a thread pool (inflating and png encoding release the gil).
+        Returns the file written by layer uuid.
+        """
+        uuids = [self.composite_uuid] + [uuid for uuid in self.layers_by_uuid
+            if uuid != self.composite_uuid]
+        chunk_lists: dict[str, list[str]] = {}
+        for uuid in uuids:
+            chunk_list = self.__chunk_list(uuid)
+            if len(chunk_list) == 0:
+                print('skipping empty layer ' + uuid)
+                continue
+            chunk_lists[uuid] = chunk_list
+        os.makedirs(out_dir, exist_ok=True)
+        out_files = { uuid: os.path.join(out_dir, uuid + '.png') for uuid in chunk_lists }
+
+        imagesize = [self.width, self.height]
+        with ThreadPoolExecutor(jobs) as executor:
+            futures = [executor.submit(write_layer,
+                out_files[uuid], self.data, uuid,
+                imagesize, self.tile_size,
+                self.orientation, self.flipped_horizontally, self.flipped_vertically,
+                strict, chunk_list) for [uuid, chunk_list] in chunk_lists.items()]
+            for future in futures:
+                future.result() # raise any failure
+        print('wrote ' + str(len(out_files)) + ' layers to ' + out_dir)
+        return out_files
+
     def write_json(self, filename):
         """Writes the plist out as a json file"""
         with open(filename + '.plist.json', 'w') as json_file:
@@ -0,0 +1,145 @@
+"""Rebuild zip archives from chkdir ranges, copying compressed entries verbatim"""
+import json
+import os
+import struct
+import zlib
+
+from .chkdir import ChkDirReader
+from .deflate import entry_data_start
+from .metrics import METRICS
+
+COPY_SIZE = 2**20 # compressed bytes copied per read
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+DIR_HEADER = struct.Struct('<4sHHHHHHIIIHHHHHII')
+EOF_HEADER = struct.Struct('<4sHHHHIIH')
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+FLAG_DATA_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+ZIP_MAX = 0xffffffff # without zip64
+
+class ZipEntry:
+    """A local zip entry in a chkdir range, as the fields needed to write it again"""
+    def __init__(self, reader: ChkDirReader, name: str, start: int, end: int) -> None:
+        header = LOCAL_HEADER.unpack(reader.read_at(start, LOCAL_HEADER.size))
+        [signature, self.version, flags, self.method, self.time, self.date,
+            self.crc, compressed_len, self.size, _, _] = header
+        if signature != b'PK\x03\x04':
+            raise Exception("No local file header at " + str(start))
+        self.name = name
+        self.data_start = entry_data_start(reader, start)
+        self.compressed_len = end - self.data_start
+        self.flags = flags & ~FLAG_DATA_DESCRIPTOR
+        if any(ord(char) > 127 for char in name):
+            self.flags |= FLAG_UTF8
+        if (flags & FLAG_DATA_DESCRIPTOR or compressed_len != self.compressed_len):
+            # crc and sizes were deferred to a data descriptor, or disagree with the range
+            self.__measure(reader, flags & FLAG_DATA_DESCRIPTOR != 0)
+
+    def __measure(self, reader: ChkDirReader, deferred: bool) -> None:
+        """
+        Compute the crc and sizes by decompressing, only needed when they are missing.
+        When deferred to a data descriptor the header's sizes are zero, so the detected range
+        stops at the data; deflate streams mark their own end so are read on to it, but the end
+        of stored data cannot be known.
+        """
+        print('[rebuild] computing crc of ' + self.name)
+        if self.method not in [ZIP_STORED, ZIP_DEFLATED]:
+            raise Exception("Cannot measure compression method " + str(self.method) + ": "
+                + self.name)
+        offset = self.data_start
+        end = self.data_start + self.compressed_len
+        if deferred:
+            if self.method == ZIP_STORED:
+                raise Exception("Stored data of unknown length (data descriptor): " + self.name)
+            end = reader.size
+        [crc, size] = [0, 0]
+        decompress = zlib.decompressobj(-zlib.MAX_WBITS) if self.method == ZIP_DEFLATED else None
+        while offset < end and (decompress is None or not decompress.eof):
+            data = reader.read_at(offset, min(COPY_SIZE, end - offset))
+            if len(data) == 0:
+                break
+            offset += len(data)
+            if decompress is None:
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                continue
+            while len(data) > 0 and not decompress.eof:
+                inflated = decompress.decompress(data, COPY_SIZE)
+                crc = zlib.crc32(inflated, crc)
+                size += len(inflated)
+                data = decompress.unconsumed_tail
+        if decompress is not None:
+            inflated = decompress.flush()
+            crc = zlib.crc32(inflated, crc)
+            size += len(inflated)
+            if not decompress.eof:
+                raise Exception("Deflate stream is truncated: " + self.name)
+            # deflate streams mark their own end, so the range may have over-run it
+            offset -= len(decompress.unused_data)
+        self.crc = crc
+        self.size = size
+        self.compressed_len = offset - self.data_start
+
+    def write(self, file, reader: ChkDirReader) -> None:
+        """Write a local header and copy the compressed data"""
+        name = self.name.encode('utf-8')
+        file.write(LOCAL_HEADER.pack(b'PK\x03\x04', self.version, self.flags, self.method,
+            self.time, self.date, self.crc, self.compressed_len, self.size, len(name), 0))
+        file.write(name)
+        offset = self.data_start
+        end = self.data_start + self.compressed_len
+        while offset < end:
+            data = reader.read_at(offset, min(COPY_SIZE, end - offset))
+            if len(data) == 0:
+                raise Exception("Range runs past the end of the chkdir: " + self.name)
+            file.write(data)
+            offset += len(data)
+        METRICS.count('rebuild.bytes_copied', self.compressed_len)
+
+    def write_dir(self, file, header_offset: int) -> None:
+        """Write a central directory record"""
+        name = self.name.encode('utf-8')
+        file.write(DIR_HEADER.pack(b'PK\x01\x02', self.version, self.version, self.flags,
+            self.method, self.time, self.date, self.crc, self.compressed_len, self.size,
+            len(name), 0, 0, 0, 0, 0, header_offset))
+        file.write(name)
+
+def rebuild_zip(out_file: str, reader: ChkDirReader, ranges: list[dict]) -> None:
+    """
+    Given [{ file, start, end }] ranges of zip entries, write them to a new zip archive with fresh
+    local headers and central directory, copying the compressed data without inflating it.
+    Entries that cannot be measured (see ZipEntry) are skipped with a message.
+    """
+    entries: list[ZipEntry] = []
+    for spec in ranges:
+        try:
+            entries.append(ZipEntry(reader, spec['file'], spec['start'], spec['end']))
+        except Exception as error: # pylint: disable=broad-except
+            print('[rebuild] skipping ' + spec['file'] + ': ' + str(error))
+
+    dirname = os.path.dirname(out_file)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(out_file, 'xb') as file:
+        offsets: list[int] = []
+        for entry in entries:
+            offsets.append(file.tell())
+            entry.write(file, reader)
+        dir_start = file.tell()
+        for [entry, offset] in zip(entries, offsets):
+            entry.write_dir(file, offset)
+        dir_end = file.tell()
+        if (dir_end > ZIP_MAX or len(entries) > 0xffff):
+            raise Exception("Rebuilt zip needs zip64, which is not supported: " + out_file)
+        file.write(EOF_HEADER.pack(b'PK\x05\x06', 0, 0, len(entries), len(entries),
+            dir_end - dir_start, dir_start, 0))
+    print('[rebuild] ' + out_file + ' (' + str(len(entries)) + ' entries)')
+
+def rebuild_ranges(filename: str, dirname: str, out_file: str) -> None:
+    """As rebuild_zip, given a json file of [{ file, start, end }] ranges and a chkdir"""
+    with open(filename, 'r') as file:
+        ranges = json.load(file)
+    reader = ChkDirReader(dirname, manifest=True)
+    rebuild_zip(out_file, reader, ranges)
+    reader.close()
@@ -1,9 +1,9 @@
 """Utilities to recover whole, but embedded, procreate drawings from a chkdir"""
-import io
 import json
 import os
 
-from .chkdir import ChkDirReader
+from .catalog import Catalog
+from .chkdir import ChkDirReader, buffered_range
 from .procreate_drawing import ProcreateDrawing
 
 
@@ -12,11 +12,9 @@ def recover_range(
 ) -> None:
     """Recover a procreate file from a chkdir"""
     print('reading ' + str(start) + '-' + str(end))
-    reader.seek(start, 0)
-    raw = reader.read(end - start)
-    data = io.BytesIO(raw)
-    procreate = ProcreateDrawing(data)
-    if procreate.validate():
+    # only the central directory and the entries used are read from the chkdir
+    procreate = ProcreateDrawing(buffered_range(reader, start, end))
+    if procreate.validate('quick' if preview_mode else 'deep'):
         print('validated procreate file')
         if not preview_mode:
             name = procreate.name if procreate.name != '$null' else "unknown"
@@ -31,7 +29,7 @@ def recover_ranges(
     chk_dirname: str, ranges: list[tuple[int, int]], out_dir: str, preview_mode: bool = False
 ) -> None:
     """Recover a set of procreate file ranges from a chkdir"""
-    reader = ChkDirReader(chk_dirname)
+    reader = ChkDirReader(chk_dirname, manifest=True) # ranges use positional reads, not maps
     for [start, end] in ranges:
         if not preview_mode:
             sub_dir = os.path.join(out_dir, str(start))
@@ -44,14 +42,24 @@ def recover_ranges(
 def recover_range_file(filename: str, chk_dirname: str, out_dir: str, preview_mode = False) -> None:
     """
     Given a JSON file of [{ valid, start, end }], generate procreate files (or previews) embedded
-    in the chkdir at [start]-[end] if [valid].
+    in the chkdir at [start]-[end] if [valid], and not failed by verify_zip.
     """
     with open(filename, 'r') as file:
         range_file = json.load(file)
     ranges: list[tuple[int, int]] = []
     for range_json in range_file:
-        if range_json['valid'] is True:
+        if range_json['valid'] is True and range_json.get('verified') is not False:
             ranges.append([range_json['start'], range_json['end']])
     # ranges = [ranges[-1]] # debugging
     print('discovered ' + str(len(ranges)) + ' files')
     recover_ranges(chk_dirname, ranges, out_dir, preview_mode)
+
+def recover_catalog(
+    catalog_filename: str, chk_dirname: str, out_dir: str, preview_mode = False
+) -> None:
+    """As recover_range_file, but for the valid zips of a detect_zip catalog"""
+    catalog = Catalog(catalog_filename)
+    ranges = [[archive['start'], archive['end']] for archive in catalog.archives(valid=True)]
+    catalog.close()
+    print('discovered ' + str(len(ranges)) + ' files')
+    recover_ranges(chk_dirname, ranges, out_dir, preview_mode)
@@ -0,0 +1,143 @@
+"""Verify detected zip entries against the CRC32 recorded in their local headers"""
+import json
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union
+
+from .catalog import Catalog
+from .chkdir import ChkDirReader
+from .detect_zip import PK_ZIP_FILE_HEADER
+from .metrics import map_measured
+
+LOCAL_HEADER_SIZE = 30
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+VERIFY_READ_SIZE = 2**20 # compressed bytes read, and most bytes inflated, per step
+VERIFY_BATCH_SIZE = 64 # fragments verified per task
+
+def verify_entry( # pylint: disable=too-many-return-statements
+    reader: ChkDirReader, start: int
+) -> tuple[Union[bool, None], int]:
+    """
+    Check the zip entry with a local header at start inflates to the CRC32 and size in its header.
+    Returns the result and the offset of the end of the entry data. The result is None when the
+    entry cannot be checked (encrypted, sizes deferred to a data descriptor or an unsupported
+    method), and False only for a missing header, truncated or corrupt data, or a crc or length
+    mismatch.
+    """
+    header = reader.read_at(start, LOCAL_HEADER_SIZE)
+    if len(header) < LOCAL_HEADER_SIZE or header[:4] != PK_ZIP_FILE_HEADER:
+        return (False, start + len(header))
+    flags = int.from_bytes(header[6:8], "little")
+    method = int.from_bytes(header[8:10], "little")
+    expected_crc = int.from_bytes(header[14:18], "little")
+    compressed_len = int.from_bytes(header[18:22], "little")
+    expected_len = int.from_bytes(header[22:26], "little")
+    name_len = int.from_bytes(header[26:28], "little")
+    ext_len = int.from_bytes(header[28:30], "little")
+    offset = start + LOCAL_HEADER_SIZE + name_len + ext_len
+    end = offset + compressed_len
+    if flags & 0x9:
+        # encrypted, or crc and sizes deferred to a data descriptor
+        return (None, end)
+    if end > reader.size:
+        return (False, end) # truncated
+
+    crc = 0
+    length = 0
+    if method == ZIP_STORED:
+        while offset < end:
+            data = reader.read_at(offset, min(VERIFY_READ_SIZE, end - offset))
+            offset += len(data)
+            crc = zlib.crc32(data, crc)
+            length += len(data)
+    elif method == ZIP_DEFLATED:
+        decompress = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            while offset < end and not decompress.eof:
+                data = reader.read_at(offset, min(VERIFY_READ_SIZE, end - offset))
+                offset += len(data)
+                while data and not decompress.eof:
+                    inflated = decompress.decompress(data, VERIFY_READ_SIZE)
+                    crc = zlib.crc32(inflated, crc)
+                    length += len(inflated)
+                    data = decompress.unconsumed_tail
+            inflated = decompress.flush()
+        except zlib.error:
+            return (False, end)
+        crc = zlib.crc32(inflated, crc)
+        length += len(inflated)
+        if not decompress.eof:
+            return (False, end)
+    else:
+        return (None, end) # unsupported compression method
+    return (crc == expected_crc and length == expected_len, end)
+
+def verified_all(results: list[Union[bool, None]]) -> Union[bool, None]:
+    """False if any entry failed, True if every entry was checked and passed, otherwise None"""
+    if any(result is False for result in results):
+        return False
+    if len(results) > 0 and all(results):
+        return True
+    return None
+
+def verify_fragment(reader: ChkDirReader, fragment: dict) -> dict:
+    """
+    Flag a detected zip fragment, and each file of a partial zip, as verified (True), failed
+    (False) or unverified (None, see verify_entry)
+    """
+    if 'files' in fragment:
+        for file in fragment['files']:
+            file['verified'] = verify_entry(reader, file['start'])[0]
+        verified = [file['verified'] for file in fragment['files']]
+    else:
+        # complete zips do not list their files, so walk the entries from the start
+        verified = []
+        offset = fragment['start']
+        while reader.read_at(offset, 4) == PK_ZIP_FILE_HEADER:
+            [entry_verified, offset] = verify_entry(reader, offset)
+            verified.append(entry_verified)
+    fragment['verified'] = verified_all(verified)
+    return fragment
+
+def verify_batch(dirname: str, fragments: list[dict]) -> list[dict]:
+    """Verify a batch of fragments from a chkdir"""
+    reader = ChkDirReader(dirname, manifest=True)
+    fragments = [verify_fragment(reader, fragment) for fragment in fragments]
+    reader.close()
+    return fragments
+
+def verify_zips(
+    filename: str, dirname: str, out_filename: Union[str, None] = None, jobs: int = 1,
+    catalog_filename: Union[str, None] = None
+) -> None:
+    """
+    Given a detect_zip json file of zip fragments, verify each fragment (and each file of partial
+    fragments) against its chkdir and write it back to out_filename (default filename) with a
+    [verified] flag, so corrupt data can be skipped without rendering it. Only False means
+    corrupt, entries that could not be checked are left None.
+    The flags are also recorded in the detect_zip catalog at catalog_filename, if given.
+    """
+    with open(filename, 'r') as file:
+        fragments: list[dict] = json.load(file)
+
+    batches = [fragments[index:index + VERIFY_BATCH_SIZE]
+        for index in range(0, len(fragments), VERIFY_BATCH_SIZE)]
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as executor:
+            results = list(map_measured(executor, verify_batch, [dirname] * len(batches), batches))
+    else:
+        results = [verify_batch(dirname, batch) for batch in batches]
+    fragments = [fragment for batch in results for fragment in batch]
+
+    failed = len([fragment for fragment in fragments if fragment['verified'] is False])
+    unverified = len([fragment for fragment in fragments if fragment['verified'] is None])
+    print('[verify] ' + str(len(fragments) - failed - unverified) + ' verified, ' + str(failed)
+        + ' failed, ' + str(unverified) + ' could not be checked')
+    with open(out_filename if out_filename is not None else filename, 'w') as file:
+        json.dump(fragments, file, indent=2)
+    if catalog_filename is not None:
+        catalog = Catalog(catalog_filename)
+        for [index, fragment] in enumerate(fragments):
+            catalog.set_verified(index + 1, fragment)
+        catalog.close()